@@ -0,0 +1,200 @@
+""" Append-only archive (.msoarc) holding many captures in one file with an index for fast lookup.
+
+The sample codes of every capture are split into chunks, each of which is stored on its own: delta coded
+(differences of consecutive codes, wrapping in the integer type; floats are coded by their bit pattern, so they are
+restored exactly), byte-shuffled (all low bytes, then all high bytes) and compressed with zlib at level 1. Any
+chunk can thus be decoded without touching the others, so a single capture or a time window of it is read without
+decompressing the rest of the archive.
+
+Files:
+    <name>.msoarc       magic (8 s) followed by the compressed chunks of all captures
+    <name>.msoarc.idx   one JSON line per capture: id, channel, timestamp, scale factors, dtype, number of samples,
+                        chunk size, (offset, length) of every chunk in the data file and optional info (e.g. the
+                        trigger settings)
+
+The index line is written after the chunks, so a capture interrupted while being appended is simply not part of
+the archive.
+"""
+
+import json
+import os
+import zlib
+import numpy as np
+
+from waveform import Waveform
+
+EXTENSION = '.msoarc'
+INDEX_EXTENSION = '.idx'
+MAGIC = b'MSOARC\r\n'
+DEFAULT_CHUNK_SIZE = 1048576  # samples
+COMPRESSION_LEVEL = 1
+
+
+class ArchiveError(Exception):
+    """the file is not a valid archive
+    """
+    pass
+
+
+def is_archive(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# integer type of the same size whose differences are coded for dtype (floats would lose bits in the cumulative sum)
+def _delta_dtype(dtype):
+    return np.dtype('<i{0}'.format(dtype.itemsize)) if dtype.kind == 'f' else dtype.newbyteorder('<')
+
+
+def encode_chunk(codes, level=COMPRESSION_LEVEL):
+    codes = np.asarray(codes)
+    dtype = _delta_dtype(codes.dtype)
+    codes = codes.astype(codes.dtype.newbyteorder('<'), copy=False).view(dtype)
+    delta = np.empty(len(codes), dtype=dtype)
+    if len(codes):
+        delta[0] = codes[0]
+        np.subtract(codes[1:], codes[:-1], out=delta[1:], dtype=dtype, casting='unsafe')  # wraps around
+    shuffled = delta.view(np.uint8).reshape(-1, dtype.itemsize).T
+    return zlib.compress(np.ascontiguousarray(shuffled).tobytes(), level)
+
+
+def decode_chunk(data, dtype):
+    dtype = np.dtype(dtype).newbyteorder('<')
+    delta_dtype = _delta_dtype(dtype)
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(delta_dtype.itemsize, -1)
+    delta = np.ascontiguousarray(shuffled.T).view(delta_dtype).ravel()
+    return np.cumsum(delta, dtype=delta_dtype).view(dtype)  # wraps around like the differences
+
+
+class ArchiveWriter:
+    """Appends captures to an archive (created if it does not exist yet)"""
+
+    # constructor
+    def __init__(self, filename, chunk_size=DEFAULT_CHUNK_SIZE, level=COMPRESSION_LEVEL):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.level = level
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            if not is_archive(filename):
+                raise ArchiveError('Not an archive.')
+            self.__n_captures = len(_read_index(filename + INDEX_EXTENSION))
+        else:
+            with open(filename, 'wb') as f:
+                f.write(MAGIC)
+            self.__n_captures = 0
+        self.__data = open(filename, 'ab')
+        self.__index = open(filename + INDEX_EXTENSION, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.__data.close()
+        self.__index.close()
+
+    # appends the waveform (raw codes with scale factors) and returns its index entry
+    def append(self, waveform, info=None):
+        raw = waveform.raw
+        chunks = []
+        for first in range(0, len(raw), self.chunk_size):
+            data = encode_chunk(raw[first:first + self.chunk_size], self.level)
+            chunks.append((self.__data.tell(), len(data)))
+            self.__data.write(data)
+        self.__data.flush()
+        entry = {"id": self.__n_captures,
+                 "channel": waveform.channel,
+                 "timestamp": waveform.timestamp,
+                 "y_mult": waveform.y_mult, "y_zero": waveform.y_zero, "x_incr": waveform.x_incr,
+                 "x_zero": waveform.x_zero, "pt_off": waveform.pt_off,
+                 "dtype": raw.dtype.newbyteorder('<').str,
+                 "n_samples": len(raw),
+                 "chunk_size": self.chunk_size,
+                 "chunks": chunks,
+                 "info": info}
+        self.__index.write(json.dumps(entry) + '\n')
+        self.__index.flush()
+        self.__n_captures += 1
+        return entry
+
+
+def _read_index(filename):
+    entries = []
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:  # incomplete last line of an interrupted append
+                    break
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+class Archive:
+    """Archive opened for reading
+
+    captures holds the index entries in the order of appending. find() looks captures up by channel and time range,
+    read() decodes a capture or only the chunks covering a time window of it.
+    """
+
+    # constructor
+    def __init__(self, filename):
+        if not is_archive(filename):
+            raise ArchiveError('Not an archive.')
+        self.filename = filename
+        self.captures = _read_index(filename + INDEX_EXTENSION)
+        timestamps = [np.nan if entry["timestamp"] is None else entry["timestamp"] for entry in self.captures]
+        self.__order = np.argsort(timestamps, kind='stable')  # NaN (unknown) sorts last
+        self.__timestamps = np.asarray(timestamps, dtype=np.float64)[self.__order]
+
+    def __len__(self):
+        return len(self.captures)
+
+    def channels(self):
+        return sorted({entry["channel"] for entry in self.captures if entry["channel"] is not None})
+
+    # index entries with start <= timestamp < stop (seconds since the epoch) of the channel, sorted by timestamp
+    def find(self, channel=None, start=None, stop=None):
+        if start is None and stop is None:
+            first, last = 0, len(self.__timestamps)  # including the captures without timestamp
+        else:
+            first = 0 if start is None else np.searchsorted(self.__timestamps, start, side='left')
+            last = (np.count_nonzero(np.isfinite(self.__timestamps)) if stop is None else
+                    np.searchsorted(self.__timestamps, stop, side='left'))
+        return [self.captures[i] for i in self.__order[first:last]
+                if channel is None or self.captures[i]["channel"] == channel]
+
+    # Decodes a capture (index entry or id). With t_start/t_stop (s, on the time axis of the waveform) only the
+    # chunks overlapping this window are read and the returned waveform covers just the window.
+    def read(self, capture, t_start=None, t_stop=None):
+        entry = self.captures[capture] if isinstance(capture, int) else capture
+        waveform = Waveform(np.empty(0, dtype=entry["dtype"]), entry["y_mult"], entry["y_zero"], entry["x_incr"],
+                            entry["x_zero"], entry["pt_off"], channel=entry["channel"], timestamp=entry["timestamp"])
+        first, stop = 0, entry["n_samples"]
+        # sample indices are rounded to 1e-6 samples first, so times given on the sample grid are not missed
+        if t_start is not None:
+            first = int(np.ceil(np.round((t_start - waveform.t_start) / waveform.x_incr, 6)))
+        if t_stop is not None:
+            stop = int(np.floor(np.round((t_stop - waveform.t_start) / waveform.x_incr, 6))) + 1
+        first, stop = max(first, 0), min(stop, entry["n_samples"])
+        raw = np.empty(max(stop - first, 0), dtype=entry["dtype"])
+        chunk_size = entry["chunk_size"]
+        with open(self.filename, 'rb') as f:
+            for i in range(first // chunk_size, (stop - 1) // chunk_size + 1 if stop > first else 0):
+                offset, length = entry["chunks"][i]
+                f.seek(offset)
+                codes = decode_chunk(f.read(length), entry["dtype"])
+                begin = i * chunk_size
+                lo, hi = max(first, begin), min(stop, begin + len(codes))
+                raw[lo - first:hi - first] = codes[lo - begin:hi - begin]
+        waveform.raw = raw
+        waveform.x_zero += first * waveform.x_incr
+        return waveform
+
+    # all captures of the channel (or all channels) taken in the time range, see find()
+    def read_range(self, start=None, stop=None, channel=None):
+        return [self.read(entry) for entry in self.find(channel, start, stop)]
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+""" Transfer and latency benchmark of the MSO54 driver against the simulated instrument (see sim_mso).
+
+For every record length, transfer encoding and transfer variant the capture-to-array time, the throughput, the
+number of round trips per capture and the peak Python memory of the driver are measured. The memory allocated by the
+simulated instrument while it answers is not part of the peak. Run e.g.
+
+    python benchmark.py --lengths 10000 1000000 10000000 --encodings int8 int16 --latency 0.001 --json results.json
+
+and compare the results before and after changes to the transfer code.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import tracemalloc
+from time import perf_counter
+import numpy as np
+
+import mso54
+import sim_mso
+
+
+def _single(instrument, channels):
+    return [instrument.transfer_waveform(channels[0])]
+
+
+def _chunked(instrument, channels):
+    dtype = instrument.ENCODING_FORMATS[instrument.resolve_encoding(integer=True)][3]  # FLOAT: int16 buffer
+    out = np.empty(instrument.get_record_length(), dtype=dtype)
+    return [instrument.transfer_waveform_into(channels[0], out)]
+
+
+def _multi(instrument, channels):
+    return instrument.transfer_waveforms(channels)
+
+
+def _acquire_and_transfer(instrument, channels):
+    instrument.acquire_single_sequence(wait_for_completion=True)
+    return [instrument.transfer_waveform(channels[0])]
+
+
+VARIANTS = {"single": _single,
+            "chunked": _chunked,
+            "multi": _multi,
+            "acquire+single": _acquire_and_transfer}
+
+
+class DriverMemory:
+    """Peak of the memory traced by tracemalloc without the memory of the simulated instrument
+
+    The I/O methods of the simulator are wrapped: the memory allocated or freed during a call is booked to the
+    simulator (e.g. the generated records and the response bytes) and the peak is reset after the call.
+    """
+
+    METHODS = ('write', 'query', 'read_bytes', 'readinto')
+
+    # constructor
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.simulator_memory = 0
+        self.peak = 0
+
+    def __enter__(self):
+        for name in self.METHODS:
+            setattr(self.simulator, name, self.__wrap(getattr(self.simulator, name)))  # instance attribute
+        tracemalloc.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__update_peak()
+        tracemalloc.stop()
+        for name in self.METHODS:
+            delattr(self.simulator, name)  # the methods of the class again
+
+    def __update_peak(self):
+        _, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak - self.simulator_memory)
+
+    def __wrap(self, method):
+        def call(*args, **kwargs):
+            self.__update_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                after, _ = tracemalloc.get_traced_memory()
+                self.simulator_memory += after - before
+                tracemalloc.reset_peak()
+        return call
+
+
+def run_variant(instrument, simulator, variant, channels, repeat):
+    results = []
+    for _ in range(repeat):
+        simulator.reset_counters()
+        with DriverMemory(simulator) as memory:
+            t_start = perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):  # the driver reports the transfer on stdout
+                waveforms = VARIANTS[variant](instrument, channels)
+            duration = perf_counter() - t_start
+        peak_memory = memory.peak
+        results.append({"time": duration,
+                        "samples": sum(len(waveform) for waveform in waveforms),
+                        "bytes": simulator.bytes_sent,
+                        "round_trips": simulator.queries,
+                        "writes": simulator.writes,
+                        "peak_memory": peak_memory})
+    best = min(results, key=lambda result: result["time"])
+    best["bytes_per_s"] = best["bytes"] / best["time"]
+    best["samples_per_s"] = best["samples"] / best["time"]
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10000, 100000, 1000000, 10000000],
+                        help='record lengths in samples')
+    parser.add_argument('--variants', nargs='+', default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument('--encodings', nargs='+', default=[mso54.Encoding.INT16.value],
+                        choices=[encoding.value for encoding in mso54.Encoding], help='transfer encodings')
+    parser.add_argument('--channels', nargs='+', default=['CH1', 'CH2'])
+    parser.add_argument('--latency', type=float, default=0.0005, help='simulated latency per command in s')
+    parser.add_argument('--bandwidth', type=float, default=40e6, help='simulated link bandwidth in bytes/s')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per measurement (best is reported)')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    manager = sim_mso.SimulatedResourceManager(latency=args.latency, bandwidth=args.bandwidth)
+    simulator = manager.instruments[sim_mso.ADDRESS]
+    instrument = mso54.MSO54(sim_mso.ADDRESS, resource_manager=manager)
+    instrument.connect()
+
+    print('{0:>16} {1:>8} {2:>10} {3:>10} {4:>10} {5:>12} {6:>7} {7:>7} {8:>10}'.format(
+        'variant', 'encoding', 'samples', 'time/ms', 'MB/s', 'samples/s', 'queries', 'writes', 'peak/MB'))
+    results = []
+    for length in args.lengths:
+        simulator.record_length = length
+        simulator.reset()
+        instrument.invalidate_settings_cache()
+        for encoding in args.encodings:
+            instrument.encoding = mso54.Encoding(encoding)
+            for variant in args.variants:
+                result = run_variant(instrument, simulator, variant, args.channels, args.repeat)
+                # the transferred encoding, e.g. int16 for auto on 12 bit instruments or for chunked float transfers
+                encoding_used = instrument.last_transfer["encoding"]
+                result.update({"variant": variant, "encoding": encoding_used, "record_length": length})
+                results.append(result)
+                print('{0:>16} {1:>8} {2:>10} {3:>10.1f} {4:>10.1f} {5:>12.3g} {6:>7} {7:>7} {8:>10.1f}'.format(
+                    variant, encoding_used, result["samples"], 1e3 * result["time"], result["bytes_per_s"] / 1e6,
+                    result["samples_per_s"], result["round_trips"], result["writes"], result["peak_memory"] / 1e6))
+    instrument.disconnect()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"latency": args.latency, "bandwidth": args.bandwidth, "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,55 @@
+""" Reusable preallocated sample buffers for repeated waveform transfers.
+
+MSO54.transfer_waveform(s) read the CURVe? data blocks straight into buffers taken from a BufferPool. When a
+waveform is not needed anymore its buffer is handed back with release(), so the next capture of the same length
+reuses the memory instead of allocating a new array.
+"""
+
+import threading
+import weakref
+import numpy as np
+
+
+class BufferPool:
+    """Thread-safe pool of numpy arrays keyed by length and type
+
+    Only buffers handed out by acquire() are taken back by release(), anything else (e.g. memory-mapped files) is
+    ignored. Buffers which are never released are simply garbage collected. Up to max_free free buffers are kept
+    per length and type.
+    """
+
+    # constructor
+    def __init__(self, max_free=4):
+        self.max_free = max_free
+        self.allocations = 0  # number of buffers allocated so far (does not grow in steady state)
+        self.__lock = threading.Lock()
+        self.__free = {}  # (length, dtype) -> list of free buffers
+        self.__lent = weakref.WeakValueDictionary()  # id -> buffer handed out
+
+    def acquire(self, n_samples, dtype=np.int16):
+        key = (n_samples, np.dtype(dtype).str)
+        with self.__lock:
+            free = self.__free.get(key)
+            if free:
+                buffer = free.pop()
+            else:
+                buffer = np.empty(n_samples, dtype=dtype)
+                self.allocations += 1
+            self.__lent[id(buffer)] = buffer
+        return buffer
+
+    # takes back a buffer (or a view of it, e.g. the raw codes of a waveform)
+    def release(self, buffer):
+        with self.__lock:
+            for candidate in (buffer, getattr(buffer, 'base', None)):
+                if candidate is not None and self.__lent.get(id(candidate)) is candidate:
+                    del self.__lent[id(candidate)]
+                    free = self.__free.setdefault((len(candidate), candidate.dtype.str), [])
+                    if len(free) < self.max_free:
+                        free.append(candidate)
+                    return True
+        return False
+
+    def clear(self):
+        with self.__lock:
+            self.__free = {}
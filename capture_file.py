@@ -0,0 +1,96 @@
+""" Native capture file format (.msocap) for waveforms fetched from Tektronix MSO oscilloscopes.
+
+A capture file consists of a small fixed-size header followed by the raw sample codes as delivered by the
+instrument. The samples are memory-mapped on import, so opening a file takes constant time and only the regions
+actually accessed are read from disk.
+
+Header layout (little endian, padded to HEADER_SIZE bytes):
+    magic (8 s), version (H), header size (H), sample dtype (4 s, numpy type string), number of samples (Q),
+    y_mult (d), y_zero (d), x_incr / sample period (d), x_zero (d), timestamp (d, seconds since epoch, NaN if
+    unknown), pt_off (q), channel (16 s)
+"""
+
+import struct
+import numpy as np
+
+from waveform import Waveform
+
+EXTENSION = '.msocap'
+MAGIC = b'MSOCAP\r\n'
+VERSION = 1
+HEADER_SIZE = 128
+_HEADER = struct.Struct('<8sHH4sQdddddq16s')
+
+
+class CaptureFileError(Exception):
+    """the file is not a valid capture file
+    """
+    pass
+
+
+def _pack_header(n_samples, dtype, y_mult, y_zero, x_incr, x_zero, pt_off, channel, timestamp):
+    header = _HEADER.pack(MAGIC, VERSION, HEADER_SIZE, np.dtype(dtype).str.encode('ascii'), n_samples,
+                          y_mult, y_zero, x_incr, x_zero, np.nan if timestamp is None else timestamp, pt_off,
+                          ('' if channel is None else channel).encode('ascii'))
+    return header.ljust(HEADER_SIZE, b'\0')
+
+
+def _unpack_header(data):
+    if len(data) < _HEADER.size or not data.startswith(MAGIC):
+        raise CaptureFileError('Not a capture file.')
+    (_, version, header_size, dtype, n_samples, y_mult, y_zero, x_incr, x_zero, timestamp, pt_off,
+     channel) = _HEADER.unpack_from(data)
+    if version > VERSION:
+        raise CaptureFileError('Capture file version {0} is not supported.'.format(version))
+    return {"header_size": header_size,
+            "dtype": np.dtype(dtype.rstrip(b'\0').decode('ascii')),
+            "n_samples": n_samples,
+            "y_mult": y_mult,
+            "y_zero": y_zero,
+            "x_incr": x_incr,
+            "x_zero": x_zero,
+            "pt_off": pt_off,
+            "channel": channel.rstrip(b'\0').decode('ascii') or None,
+            "timestamp": None if np.isnan(timestamp) else timestamp}
+
+
+def is_capture_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# writes the waveform to the file (file name or binary file object) chunk by chunk
+def write(f, waveform, chunk_size=4194304):
+    if isinstance(f, str):
+        with open(f, 'wb') as file:
+            return write(file, waveform, chunk_size)
+    raw = waveform.raw
+    dtype = np.dtype(raw.dtype).newbyteorder('<')
+    f.write(_pack_header(len(raw), dtype, waveform.y_mult, waveform.y_zero, waveform.x_incr, waveform.x_zero,
+                         waveform.pt_off, waveform.channel, waveform.timestamp))
+    for first in range(0, len(raw), chunk_size):
+        f.write(np.asarray(raw[first:first + chunk_size], dtype=dtype).tobytes())
+
+
+# Creates a capture file for n_samples samples and returns the writable memory-mapped sample array, e.g. to
+# stream a transfer directly into the file.
+def create(filename, n_samples, preamble, channel=None, timestamp=None, dtype='<i2'):
+    dtype = np.dtype(dtype)
+    with open(filename, 'wb') as f:
+        f.write(_pack_header(n_samples, dtype, preamble["y_mult"], preamble["y_zero"], preamble["x_incr"],
+                             preamble["x_zero"], preamble["pt_off"], channel, timestamp))
+        f.truncate(HEADER_SIZE + n_samples * dtype.itemsize)
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=HEADER_SIZE, shape=(n_samples,))
+
+
+# opens the capture file and returns a Waveform whose raw codes are memory-mapped (read-only)
+def read(filename):
+    with open(filename, 'rb') as f:
+        header = _unpack_header(f.read(HEADER_SIZE))
+    if header["n_samples"] == 0:
+        raw = np.empty(0, dtype=header["dtype"])
+    else:
+        raw = np.memmap(filename, dtype=header["dtype"], mode='r', offset=header["header_size"],
+                        shape=(header["n_samples"],))
+    return Waveform(raw, header["y_mult"], header["y_zero"], header["x_incr"], header["x_zero"], header["pt_off"],
+                    channel=header["channel"], timestamp=header["timestamp"])
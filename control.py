@@ -1,8 +1,14 @@
 import numpy as np
 
 from view import View  # '.' indicates relative import
+import archive
+import capture_file
+import digital
+import export
 import threading
 import os
+import re
+from time import perf_counter
 
 
 class Control:
@@ -13,11 +19,21 @@ class Control:
         # create view object (MVC-pattern)
         self.view = View(self)
         self.model = model
+        self.model.set_dispatcher(self.view.post)  # the instrument I/O runs in the worker thread of the model
         self.model.attach(self)  # control is now an observer of model (update(model_state))
         self.view.timer(1000, self.model.timer_routine)
-        # threading.Timer(10, lambda: self.__timer_routine(1, self.model.timer_routine)).run()
-        self.data = {"sample_period": None, "data": None, "time": None}
+        self.data = None  # list of waveform.Waveform or digital.DigitalWaveform (one per channel)
         self.label = None
+        self.trigger = None  # trigger settings of data imported from an archive (see MSO54.get_trigger_settings())
+        self.__from_instrument = False  # data has been read from the instrument
+        self.__live = False
+        self.__frame = None  # frame shown in live mode (its buffer is handed back to the model with the next one)
+        self.__frame_arrival = None
+        self.__frame_rate = None
+        # interactive mode: overview of the record, details of the visible range are fetched on zoom (see regions)
+        self.__overview = None
+        self.__view_range = None
+        self.__read_start = None
 
     # public methods
     # def __timer_routine(self, interval_ms, func):
@@ -37,59 +53,289 @@ class Control:
         # view.show() has to be called at very last as the tkinter mainloop() blocks every line of code coming after
         self.view.show()
 
+    def window_close(self):
+        if self.__live:
+            self.button_run_click()  # stops live mode
+        self.model.close()
+        self.view.close()
+
+    def button_run_click(self):
+        self.__overview = None
+        if self.__live:
+            self.__live = False
+            self.model.stop_continuous()
+            self.view.stop_live()
+        else:
+            self.__live = True
+            self.__frame = None  # the buffers of a previous run are not reused
+            self.__frame_arrival = None
+            self.__frame_rate = None
+            self.view.start_live()
+            channels = self.view.selected_channels()
+            if not channels:
+                self.button_run_click()
+                self.view.show_errorbox('No channel selected', 'Please choose a channel.')
+                return
+            if self.model.is_digital(channels[0]):
+                self.button_run_click()
+                self.view.show_errorbox('Digital channel selected', 'Live mode shows analog channels only.')
+                return
+            # live mode shows the first selected channel only
+            self.model.start_continuous(channels[0], self.__frame_received, self.__live_failed)
+
     def button_import_click(self):
+        self.__overview = None
         self.__file_import()
         if self.data is None:
             self.view.show_errorbox('No data retrieved from file.',
                                     'Please check file.')
         else:
-            self.view.simple_plot(self.data["time"], self.data["data"])
+            self.view.plot_waveforms(self.data)
 
     def button_export_click(self):
-        # in a future version the user is asked in which format he wants to export
-        # options will be:
-        #   - as new .csv
-        #   - as new .lib file (Saves data as a SPICE subcircuit)
-        #   - append to existing .lib file (file will be checked for duplicate and user asked for name change/overwrite)
+        # the format is chosen by the file extension:
+        #   - .msocap / .npz (raw codes with scale factors, can be imported again)
+        #   - .msoarc (all channels are appended to the archive)
+        #   - .csv
+        #   - .lib (saves data as a SPICE subcircuit, an existing library can be appended to)
+        # digital channels are saved bit-packed to .npz or as list of edges to .csv
         self.__file_save()
 
-    def button_read_click(self):
-        # read in data and show immediately in diagram
-        self.data = self.model.data(self.view.channel.get())
+    def button_measure_click(self):
+        # measures the shown waveforms in the background
         if self.data is None:
+            self.view.show_errorbox('No data to measure', 'Please read or import data first.')
+            return
+        waveforms = [waveform for waveform in self.data if not isinstance(waveform, digital.DigitalWaveform)]
+        if not waveforms:
+            self.view.show_errorbox('No data to measure', 'The measurements need analog channels.')
+            return
+        self.model.request_measurements(waveforms, lambda results: self.view.show_measurements(waveforms, results),
+                                        self.__measurement_failed)
+
+    def button_read_click(self):
+        # read in data in the background and show it in the diagram as soon as it has arrived
+        channels = self.view.selected_channels()
+        if not channels:
+            self.view.show_errorbox('No channel selected', 'Please choose one or more channels.')
+            return
+        self.__overview = None
+        if self.view.interactive_mode():
+            # a coarse overview is shown first, zooming in fetches the visible range at full resolution
+            if any(self.model.is_digital(channel) for channel in channels):
+                self.view.show_errorbox('Digital channel selected', 'Zooming into details works for analog '
+                                                                   'channels only.')
+                return
+            self.__read_start = perf_counter()
+            self.model.request_overview(channels, self.__overview_received, self.__data_failed)
+        else:
+            self.model.request_waveforms(channels, self.__data_received, self.__data_failed)
+
+    # called by the view when zooming or panning has come to rest
+    def view_range_changed(self, t_start, t_stop):
+        if self.__overview is None:
+            return
+        view_range = (t_start, t_stop)
+        self.__view_range = view_range
+        self.model.request_region(t_start, t_stop, lambda data: self.__region_received(view_range, data),
+                                  self.__data_failed)
+
+    # private methods
+    def __data_received(self, data):
+        if data is None:
             self.view.show_errorbox('No data retrieved from instrument',
                                     'Please check connection, VISA driver, instrument status...')
         else:
-            if len(self.data["time"]) > 1e6:
-                self.view.show_warningbox('Plotting', 'Too much data to be plotted here.')
-            else:
-                self.view.simple_plot(self.data["time"], self.data["data"])
+            previous, self.data = self.data, data
+            self.trigger, self.__from_instrument = None, True
+            self.view.plot_waveforms(self.data)
+            self.model.release_waveforms(previous)  # not shown anymore, the buffers are reused by the next read
+            io = self.model.last_transfer_io
+            if io is not None:
+                self.view.update_perfbar('{0} commands, I/O {1:.0f} ms, {2:.1f} MB, {3} errors'.format(
+                    io["messages"], 1e3 * io["time"], io["bytes"] / 1e6, io["errors"]))
+
+    def __overview_received(self, data):
+        if data is None:
+            self.view.show_errorbox('No data retrieved from instrument',
+                                    'Please check connection, VISA driver, instrument status...')
+            return
+        previous, self.data = self.data, data
+        self.trigger, self.__from_instrument = None, True
+        self.__overview = data
+        self.view.plot_waveforms(data)
+        self.model.release_waveforms(previous)
+        self.view.update_perfbar('overview of {0} samples shown after {1:.0f} ms'.format(
+            len(data[0]), 1e3 * (perf_counter() - self.__read_start)))
+
+    def __region_received(self, view_range, data):
+        if self.__overview is None or view_range != self.__view_range:  # outdated by another zoom or read
+            return
+        if data is None:  # too wide for details
+            self.data = self.__overview
+            self.view.show_details([])
+            return
+        cache = self.model.region_cache
+        self.data = data  # export and measure the visible range at full resolution
+        self.view.show_details(data)
+        self.view.update_perfbar('{0} samples at full resolution, cache {1:.1f} MB ({2} blocks hit, {3} fetched)'
+                                 .format(len(data[0]), cache.nbytes / 1e6, cache.hits, cache.misses))
+
+    def __frame_received(self, frame):
+        if self.__frame is not None:
+            self.model.release_frame(self.__frame)
+        self.__frame = frame
+        if not self.__live:  # frame was already on its way when live mode has been stopped
+            return
+        self.data = [frame["waveform"]]
+        self.trigger, self.__from_instrument = None, True
+        now = perf_counter()
+        if self.__frame_arrival is not None:
+            rate = 1 / (now - self.__frame_arrival)
+            self.__frame_rate = rate if self.__frame_rate is None else 0.8 * self.__frame_rate + 0.2 * rate
+        self.__frame_arrival = now
+        self.view.update_live(frame["waveform"])
+        render_time = perf_counter() - now
+        self.view.update_perfbar('{0:.1f} updates/s, transfer {1:.0f} ms, render {2:.0f} ms'.format(
+            self.__frame_rate or 0.0, 1e3 * frame["transfer_time"], 1e3 * render_time))
+
+    def __live_failed(self, error):
+        if self.__live:
+            self.button_run_click()
+        self.__data_failed(error)
+
+    def __measurement_failed(self, error):
+        self.view.show_errorbox('Measurement failed', str(error))
+
+    def __data_failed(self, error):
+        self.view.show_errorbox('Data transfer failed', str(error))
 
-    # private methods
     def __file_save(self):
-        f = self.view.save_as_csvfile_dialog()
-        if f is None:
+        if self.data is None:
+            self.view.show_errorbox('No data to export', 'Please read or import data first.')
+            return
+        filename = self.view.export_file_dialog()
+        if not filename:
+            return
+        extension = os.path.splitext(filename)[1].lower()
+        analog = [waveform for waveform in self.data if not isinstance(waveform, digital.DigitalWaveform)]
+        if len(analog) < len(self.data) and extension not in ('.npz', '.csv'):
+            self.view.show_errorbox('Export', 'Digital channels can be exported to .npz or .csv files only.')
+            return
+        if extension == '.lib':
+            self.__spice_lib_save(filename)
+            return
+        if extension == archive.EXTENSION:
+            if self.__from_instrument:  # the trigger settings are queried now, by the worker thread writing the archive
+                self.model.submit(self.__instrument_archive_save, filename, self.data,
+                                  on_error=lambda error: self.view.show_errorbox('Export failed', str(error)))
+            else:
+                self.__archive_save(filename, self.data, self.trigger)
+            return
+        if os.path.exists(filename) and not self.view.ask_ok_cancel('Export', filename + ' exists. Overwrite?'):
             return
         print('Start saving data to file...', end='')
-        # np.save(f, self.data["time"])
-        # np.savez(f, time=self.data["time"], data=self.data["data"])
-        np.savez(f, sample_period=self.data["sample_period"], data=self.data["data"])
-        # np.savez_compressed(f, time=self.data["time"], data=self.data["data"])
-        f.close()
+        if extension == '.csv':
+            if analog:
+                export.write_csv(filename, analog)  # one column per channel
+            for waveform in self.data:
+                if isinstance(waveform, digital.DigitalWaveform):  # edge list per digital channel
+                    name = filename if not analog and len(self.data) == 1 else '{0}_{1}{2}'.format(
+                        os.path.splitext(filename)[0], waveform.channel, extension)
+                    export.write_edges_csv(name, waveform)
+        else:
+            for waveform in self.data:
+                # with several channels every channel is written to its own file
+                if len(self.data) > 1:
+                    name = '{0}_{1}{2}'.format(os.path.splitext(filename)[0], waveform.channel, extension)
+                else:
+                    name = filename
+                # raw codes and scale factors are stored, volts and time are recomputed on import
+                if extension == '.npz':
+                    with open(name, 'wb') as f:
+                        waveform.save_npz(f)
+                else:
+                    capture_file.write(name, waveform)
         print(' finished.')
 
+    def __archive_save(self, filename, data, trigger):
+        print('Start appending data to archive...', end='')
+        with archive.ArchiveWriter(filename) as writer:
+            for waveform in data:
+                writer.append(waveform, info={"trigger": trigger})
+        print(' finished.')
+
+    def __instrument_archive_save(self, filename, data):
+        self.__archive_save(filename, data, self.model.trigger_settings())
+
+    def __spice_lib_save(self, filename):
+        append = False
+        if os.path.exists(filename):
+            append = self.view.ask_yes_no_cancel('Export', filename + ' exists. Append the subcircuits to it? '
+                                                           '(no overwrites the whole file)')
+            if append is None:
+                return
+        for waveform in self.data:
+            if not self.__subcircuit_save(filename, waveform, append):
+                return
+            append = True
+
+    def __subcircuit_save(self, filename, waveform, append):
+        name = re.sub(r'\W', '_', waveform.channel or os.path.splitext(os.path.basename(filename))[0])
+        overwrite = False
+        while True:
+            name = self.view.ask_string('Export', 'Name of the subcircuit:', name)
+            if not name:
+                return False
+            try:
+                print('Start saving data to file...', end='')
+                export.write_spice_lib(filename, waveform, name, append=append, overwrite=overwrite)
+                print(' finished.')
+                return True
+            except export.DuplicateSubcircuitError:
+                print(' aborted.')
+                overwrite = self.view.ask_yes_no_cancel('Export', 'Subcircuit ' + name + ' already exists. '
+                                                        'Overwrite it? (no chooses another name)')
+                if overwrite is None:
+                    return False
+
     def __file_import(self):
         f = self.view.read_as_csvfile_dialog()
         if f is None:
             return
+        if archive.is_archive(f.name):
+            self.__archive_import(f.name)
+            f.close()
+            return
         print('Start importing data from file...', end='')
-        raw_data = np.load(f)
-        # the dictionary fields in raw_data have to be actively called in order to decompress and store the array in
-        # memory before being able to close the file with f.close()
-        # self.data["time"] = raw_data["time"]
-        self.data["sample_period"] = raw_data["sample_period"]
-        self.data["data"] = raw_data["data"]
-        self.data["time"] = np.linspace(0, (len(raw_data["data"])-1) * raw_data["sample_period"], len(raw_data["data"]))
+        if capture_file.is_capture_file(f.name):
+            self.data = [capture_file.read(f.name)]  # memory-mapped, only the viewed regions are read
+        else:
+            self.data = [digital.load_npz(f)]  # analog or digital
+        self.trigger, self.__from_instrument = None, False
         self.label = os.path.basename(f.name)
         f.close()
         print(' finished.')
+
+    # imports one capture of an archive together with the other channels captured at the same time
+    def __archive_import(self, filename):
+        captures = archive.Archive(filename)
+        if len(captures) == 0:
+            self.data = None
+            return
+        number = self.view.ask_string('Import', 'Capture number (1 to {0}):'.format(len(captures)), str(len(captures)))
+        if number is None:
+            return
+        try:
+            entry = captures.captures[int(number) - 1]
+        except (ValueError, IndexError):
+            self.view.show_errorbox('Import', 'There is no capture ' + number + '.')
+            return
+        print('Start importing data from archive...', end='')
+        if entry["timestamp"] is None:
+            self.data = [captures.read(entry)]
+        else:
+            self.data = captures.read_range(entry["timestamp"], entry["timestamp"] + 1e-6)
+        self.trigger, self.__from_instrument = (entry["info"] or {}).get("trigger"), False
+        self.label = os.path.basename(filename)
+        print(' finished.')
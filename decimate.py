@@ -0,0 +1,75 @@
+""" Min/max (envelope) decimation of long waveform records for plotting.
+
+Every output bin keeps the minimum and the maximum sample in their original order, so narrow glitches stay visible
+even if the record is reduced to the width of the screen. The functions work on the raw codes of a Waveform; only
+the few remaining points have to be scaled to volts.
+"""
+
+import numpy as np
+
+
+# Returns the indices and values of the minimum and maximum of every one of (at most) n_bins bins of samples.
+def minmax_decimate(samples, n_bins):
+    n = len(samples)
+    if n <= 2 * n_bins:
+        return np.arange(n), np.asarray(samples[:])
+    index = _minmax_index(np.asarray(samples[:]), np.arange(n), n_bins)
+    return index, samples[index]
+
+
+class EnvelopeDecimator:
+    """Min/max decimation with constant cost per call
+
+    The indices of the minimum and maximum of every bin of bin_size samples are computed once for the whole record.
+    Requests spanning many of those bins are then served from this envelope instead of the samples.
+    """
+
+    # constructor
+    def __init__(self, samples, bin_size=1024, chunk_size=4194304):
+        self.samples = samples
+        self.bin_size = bin_size
+        n_bins = len(samples) // bin_size
+        self.i_min = np.empty(n_bins, dtype=np.int64)
+        self.i_max = np.empty(n_bins, dtype=np.int64)
+        bins_per_chunk = max(chunk_size // bin_size, 1)
+        for first in range(0, n_bins, bins_per_chunk):
+            last = min(first + bins_per_chunk, n_bins)
+            blocks = np.asarray(samples[first * bin_size:last * bin_size]).reshape(last - first, bin_size)
+            offsets = np.arange(first, last) * bin_size
+            self.i_min[first:last] = blocks.argmin(axis=1) + offsets
+            self.i_max[first:last] = blocks.argmax(axis=1) + offsets
+
+    def __len__(self):
+        return len(self.samples)
+
+    # returns the indices and values of the decimated samples[start:stop] with at most 2 * n_bins points
+    def decimate(self, start, stop, n_bins):
+        start = max(int(start), 0)
+        stop = min(int(stop), len(self.samples))
+        if stop <= start:
+            return np.empty(0, dtype=np.int64), self.samples[0:0]
+        first_bin = -(-start // self.bin_size)
+        last_bin = stop // self.bin_size
+        if last_bin - first_bin <= 2 * n_bins:
+            index, values = minmax_decimate(self.samples[start:stop], n_bins)
+            return index + start, values
+        # the partial bins at the borders are left out (they are narrower than a single output bin)
+        candidates = np.stack((self.i_min[first_bin:last_bin], self.i_max[first_bin:last_bin]), axis=1)
+        candidates = np.sort(candidates, axis=1).ravel()
+        index = _minmax_index(self.samples[candidates], candidates, n_bins)
+        return index, self.samples[index]
+
+
+# returns the sorted indices of the minimum and maximum value of (at most) n_bins groups of values
+def _minmax_index(values, index, n_bins):
+    group = -(-len(values) // n_bins)  # ceil
+    n_groups = -(-len(values) // group)
+    padding = n_groups * group - len(values)
+    if padding:
+        values = np.pad(values, (0, padding), mode='edge')
+        index = np.pad(index, (0, padding), mode='edge')
+    values = values.reshape(n_groups, group)
+    index = index.reshape(n_groups, group)
+    rows = np.arange(n_groups)
+    result = np.stack((index[rows, values.argmin(axis=1)], index[rows, values.argmax(axis=1)]), axis=1)
+    return np.sort(result, axis=1).ravel()
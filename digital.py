@@ -0,0 +1,153 @@
+""" Bit-packed container for digital (logic) waveforms, e.g. the CHx_DALL and CHx_Dn sources of a FlexChannel
+with a logic probe.
+
+Every lane is stored with one bit per sample (np.packbits, little bit order), so 8 lanes of a record take as much
+memory as the record has samples in bytes. Transitions are found on the packed bytes: XOR with the stream shifted
+by one sample marks every bit that differs from its predecessor, and only the non-zero bytes are unpacked. Edge
+lists and run-length encoding are therefore cheap even for very long records with few transitions.
+"""
+
+import numpy as np
+
+from waveform import Waveform
+
+CHUNK_SIZE = 4194304  # samples unpacked at once (multiple of 8)
+
+
+class DigitalWaveform:
+    __slots__ = ('packed', 'n_samples', 'lane_names', 'x_incr', 'x_zero', 'pt_off', 'channel', 'timestamp')
+
+    # constructor
+    # packed: uint8 array with one row of np.packbits(..., bitorder='little') per lane
+    def __init__(self, packed, n_samples, lane_names=None, x_incr=1.0, x_zero=0.0, pt_off=0, channel=None,
+                 timestamp=None):
+        self.packed = np.atleast_2d(np.asarray(packed, dtype=np.uint8))
+        self.n_samples = int(n_samples)
+        self.lane_names = list(lane_names) if lane_names is not None else [
+            'D{0}'.format(lane) for lane in range(len(self.packed))]
+        self.x_incr = float(x_incr)
+        self.x_zero = float(x_zero)
+        self.pt_off = int(pt_off)
+        self.channel = channel
+        self.timestamp = timestamp
+
+    # Packs the bytes delivered by the instrument: every bit of a sample is a lane (CHx_DALL: bit n is Dn), with
+    # lanes=None all 8 bits. Single lane sources (CHx_Dn) deliver 0 or 1 per sample, use lanes=[0] for them.
+    @classmethod
+    def from_samples(cls, samples, preamble=None, lanes=None, lane_names=None, channel=None, timestamp=None):
+        samples = np.asarray(samples)
+        samples = samples.view(np.uint8) if samples.dtype.itemsize == 1 else samples.astype(np.uint8)
+        lanes = list(range(8)) if lanes is None else list(lanes)
+        packed = np.empty((len(lanes), (len(samples) + 7) // 8), dtype=np.uint8)
+        for first in range(0, len(samples), CHUNK_SIZE):
+            chunk = samples[first:first + CHUNK_SIZE]
+            for row, lane in enumerate(lanes):
+                bits = np.packbits((chunk >> lane) & 1, bitorder='little')
+                packed[row, first // 8:first // 8 + len(bits)] = bits
+        preamble = preamble or {}
+        return cls(packed, len(samples), lane_names, preamble.get("x_incr", 1.0), preamble.get("x_zero", 0.0),
+                   preamble.get("pt_off", 0), channel=channel, timestamp=timestamp)
+
+    def __len__(self):
+        return self.n_samples
+
+    @property
+    def n_lanes(self):
+        return len(self.packed)
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    # time axis as for waveform.Waveform
+    @property
+    def sample_period(self):
+        return self.x_incr
+
+    @property
+    def t_start(self):
+        return (-1 * self.pt_off * self.x_incr) + self.x_zero
+
+    @property
+    def t_stop(self):
+        return self.t_start + (self.n_samples - 1) * self.x_incr
+
+    def time_at(self, index):
+        return self.t_start + index * self.x_incr
+
+    def index_at(self, t):
+        index = np.rint((np.asarray(t) - self.t_start) / self.x_incr).astype(np.int64)
+        return np.clip(index, 0, self.n_samples - 1)
+
+    def lane_index(self, lane):
+        return self.lane_names.index(lane) if isinstance(lane, str) else lane
+
+    # levels (0/1 as uint8) of a lane between start and stop
+    def levels(self, lane, start=None, stop=None):
+        start, stop, _ = slice(start, stop).indices(self.n_samples)
+        if stop <= start:
+            return np.empty(0, dtype=np.uint8)
+        packed = self.packed[self.lane_index(lane), start // 8:(stop + 7) // 8]
+        return np.unpackbits(packed, bitorder='little')[start % 8:start % 8 + stop - start]
+
+    def level_at(self, lane, index):
+        index = np.asarray(index)
+        return (self.packed[self.lane_index(lane), index // 8] >> (index % 8)) & 1
+
+    # Indices of the samples whose level differs from the previous sample (the first sample is no transition),
+    # returns (indices, levels after the transition) with level 1 for rising and 0 for falling edges.
+    def edges(self, lane):
+        packed = self.packed[self.lane_index(lane)]
+        previous = np.empty_like(packed)
+        previous[1:] = packed[1:] << 1 | packed[:-1] >> 7  # the stream delayed by one sample
+        if len(packed):
+            previous[0] = packed[0] << 1 | packed[0] & 1  # the first sample has no predecessor
+        changed = packed ^ previous
+        if self.n_samples % 8 and len(changed):
+            changed[-1] &= (1 << self.n_samples % 8) - 1  # padding bits of the last byte
+        byte_index = np.flatnonzero(changed)
+        bits = np.unpackbits(changed[byte_index][:, None], axis=1, bitorder='little')
+        rows, columns = np.nonzero(bits)
+        index = byte_index[rows].astype(np.int64) * 8 + columns
+        return index, self.level_at(lane, index)
+
+    # run-length encoding of a lane: (levels, start indices, lengths) of the runs of equal level
+    def rle(self, lane):
+        if self.n_samples == 0:
+            return np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        index, _ = self.edges(lane)
+        starts = np.concatenate(([0], index))
+        lengths = np.diff(np.concatenate((starts, [self.n_samples])))
+        return self.level_at(lane, starts), starts, lengths
+
+    # step trace of a lane for plotting with drawstyle='steps-post': times of the edges and the levels after them
+    def step_trace(self, lane):
+        levels, starts, _ = self.rle(lane)
+        if len(starts) == 0:
+            return np.empty(0), np.empty(0, dtype=np.uint8)
+        times = self.time_at(np.concatenate((starts, [self.n_samples - 1])))
+        return times, np.concatenate((levels, levels[-1:]))
+
+    # file methods
+    def save_npz(self, f):
+        np.savez(f, packed=self.packed, n_samples=self.n_samples, lane_names=np.array(self.lane_names),
+                 x_incr=self.x_incr, x_zero=self.x_zero, pt_off=self.pt_off,
+                 channel='' if self.channel is None else self.channel,
+                 timestamp=np.nan if self.timestamp is None else self.timestamp)
+
+    @classmethod
+    def load_npz(cls, f):
+        npz = np.load(f)
+        timestamp = float(npz["timestamp"])
+        return cls(npz["packed"], int(npz["n_samples"]), [str(name) for name in npz["lane_names"]], npz["x_incr"],
+                   npz["x_zero"], int(npz["pt_off"]), channel=str(npz["channel"]) or None,
+                   timestamp=None if np.isnan(timestamp) else timestamp)
+
+
+# loads an analog (waveform.Waveform) or digital waveform saved with save_npz() from a binary file object
+def load_npz(f):
+    if 'packed' in np.load(f).files:
+        f.seek(0)
+        return DigitalWaveform.load_npz(f)
+    f.seek(0)
+    return Waveform.load_npz(f)
@@ -0,0 +1,158 @@
+""" Streaming exporters for waveforms (CSV and SPICE subcircuit libraries).
+
+The waveforms are written chunk by chunk and every chunk is formatted as one block, so memory stays flat and no
+Python loop runs per sample, even for records with tens of millions of samples.
+"""
+
+import os
+import re
+import tempfile
+import numpy as np
+
+from decimate import EnvelopeDecimator
+from waveform import Waveform
+
+CHUNK_SIZE = 65536  # samples formatted at once
+
+
+class DuplicateSubcircuitError(Exception):
+    """a subcircuit with the same name already exists in the library
+    """
+    pass
+
+
+# formats the columns (sequence of equally long 1d arrays) as lines of text with one format per column
+def _format_block(columns, formats, separator):
+    line = separator.join(formats) + '\n'
+    block = np.column_stack(columns)
+    return (line * len(block)) % tuple(block.ravel().tolist())
+
+
+# Writes the waveform (or a list of waveforms with the same time base) to the CSV file (file name or text file
+# object). The first column is the time in s, followed by one column per waveform with the voltage in V.
+def write_csv(f, waveforms, chunk_size=CHUNK_SIZE, time_format='%.12e', value_format='%.6e'):
+    if isinstance(f, str):
+        with open(f, 'w', newline='') as file:
+            return write_csv(file, waveforms, chunk_size, time_format, value_format)
+    if isinstance(waveforms, Waveform):
+        waveforms = [waveforms]
+    reference = waveforms[0]
+    for waveform in waveforms[1:]:
+        if len(waveform) != len(reference) or waveform.t_start != reference.t_start:
+            raise ValueError('The waveforms have to share the same time base.')
+    f.write(','.join(['time in s'] + ['{0} in V'.format(waveform.channel or 'voltage') for waveform in waveforms]))
+    f.write('\n')
+    formats = (time_format,) + (value_format,) * len(waveforms)
+    for first in range(0, len(reference), chunk_size):
+        last = min(first + chunk_size, len(reference))
+        columns = [reference.time(first, last)] + [waveform.volts(first, last) for waveform in waveforms]
+        f.write(_format_block(columns, formats, ','))
+
+
+# Writes the transitions of a digital.DigitalWaveform to the CSV file (file name or text file object): one line per
+# edge with the time in s, the lane and the level after the edge, sorted by time. The first lines hold the initial
+# level of every lane at the start of the record. Nothing is expanded to one value per sample.
+def write_edges_csv(f, waveform, chunk_size=CHUNK_SIZE, time_format='%.12e'):
+    if isinstance(f, str):
+        with open(f, 'w', newline='') as file:
+            return write_edges_csv(file, waveform, chunk_size, time_format)
+    f.write('time in s,lane,level\n')
+    index, lanes, levels = [], [], []
+    for lane in range(waveform.n_lanes):
+        lane_levels, starts, _ = waveform.rle(lane)
+        index.append(starts)
+        lanes.append(np.full(len(starts), lane))
+        levels.append(lane_levels)
+    if not index:
+        return
+    index, lanes, levels = np.concatenate(index), np.concatenate(lanes), np.concatenate(levels)
+    order = np.lexsort((lanes, index))
+    names = np.array(waveform.lane_names, dtype=object)
+    for first in range(0, len(order), chunk_size):
+        chunk = order[first:first + chunk_size]
+        columns = [waveform.time_at(index[chunk]), names[lanes[chunk]], levels[chunk]]
+        f.write(_format_block(columns, (time_format, '%s', '%d'), ','))
+
+
+# Returns the indices of the samples needed for a PWL source. With tolerance=0 only samples in the middle of a
+# straight line are dropped, which is lossless for the piecewise linear interpretation. A tolerance (in codes, for
+# float data e.g. of earlier file versions in V) drops also the samples where the slope changes by at most that
+# amount. max_points limits the number of points by min/max decimation.
+def pwl_indices(waveform, tolerance=0, max_points=None, chunk_size=CHUNK_SIZE):
+    raw = waveform.raw
+    n = len(raw)
+    if max_points is not None and n > max_points:
+        index, _ = EnvelopeDecimator(raw).decimate(0, n, max(max_points // 2 - 1, 1))
+        return np.unique(np.concatenate(([0], index, [n - 1])))
+    if n <= 2:
+        return np.arange(n)
+    if np.issubdtype(raw.dtype, np.integer):
+        dtype = np.int64
+    else:  # float data must not be truncated, the tolerance is scaled to its units
+        dtype = np.float64
+        tolerance = tolerance / abs(waveform.y_mult) if waveform.y_mult else tolerance
+    parts = [np.zeros(1, dtype=np.int64)]
+    for first in range(1, n - 1, chunk_size):
+        last = min(first + chunk_size, n - 1)
+        # one sample of overlap on each side for the second difference
+        codes = np.asarray(raw[first - 1:last + 1], dtype=dtype)
+        curvature = np.abs(codes[:-2] - 2 * codes[1:-1] + codes[2:])
+        parts.append(np.flatnonzero(curvature > tolerance) + first)
+    parts.append(np.array([n - 1], dtype=np.int64))
+    return np.concatenate(parts)
+
+
+def find_subcircuits(filename):
+    names = []
+    pattern = re.compile(r'^\s*\.subckt\s+(\S+)', re.IGNORECASE)
+    with open(filename, 'r') as f:
+        for line in f:
+            match = pattern.match(line)
+            if match:
+                names.append(match.group(1))
+    return names
+
+
+# removes the subcircuit from the library (the file is rewritten line by line)
+def remove_subcircuit(filename, name):
+    start = re.compile(r'^\s*\.subckt\s+' + re.escape(name) + r'(\s|$)', re.IGNORECASE)
+    end = re.compile(r'^\s*\.ends\b', re.IGNORECASE)
+    directory = os.path.dirname(os.path.abspath(filename))
+    with open(filename, 'r') as source, tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as target:
+        skipping = False
+        for line in source:
+            if not skipping and start.match(line):
+                skipping = True
+            elif skipping:
+                if end.match(line):
+                    skipping = False
+            else:
+                target.write(line)
+    os.replace(target.name, filename)
+
+
+# Writes the waveform as SPICE subcircuit with a PWL voltage source between the pins "out" and "ref". The time axis
+# starts at zero. With append=True the subcircuit is added to an existing library; if a subcircuit with the same
+# name exists already, DuplicateSubcircuitError is raised unless overwrite=True.
+def write_spice_lib(filename, waveform, name, append=False, overwrite=False, tolerance=0, max_points=None,
+                    chunk_size=CHUNK_SIZE):
+    if append and os.path.exists(filename):
+        if name.lower() in map(str.lower, find_subcircuits(filename)):
+            if not overwrite:
+                raise DuplicateSubcircuitError('Subcircuit ' + name + ' already exists in ' + filename + '.')
+            remove_subcircuit(filename, name)
+        mode = 'a'
+    else:
+        mode = 'w'
+    index = pwl_indices(waveform, tolerance, max_points, chunk_size)
+    with open(filename, mode) as f:
+        f.write('.SUBCKT {0} out ref\n'.format(name))
+        f.write('* {0}, sample period {1:g} s, {2} of {3} samples\n'.format(
+            waveform.channel or 'waveform', waveform.x_incr, len(index), len(waveform)))
+        f.write('V1 out ref PWL(\n')
+        for first in range(0, len(index), chunk_size):
+            block = index[first:first + chunk_size]
+            f.write(_format_block((block * waveform.x_incr, waveform.to_volts(waveform.raw[block])),
+                                  ('+ %.12e', '%.6e'), ' '))
+        f.write('+ )\n')
+        f.write('.ENDS {0}\n\n'.format(name))
@@ -0,0 +1,182 @@
+""" Destinations for FastFrame (segmented) acquisitions, see MSO54.transfer_fast_frames().
+
+A frame sink is prepared with begin(preamble, frame_length, channel) and then receives the frames in batches with
+append(frames, timestamps), where frames is a 2d array (one frame per row) and timestamps holds the trigger time of
+every frame in nanoseconds since the epoch (instrument clock).
+
+FrameRingBuffer keeps the latest frames in preallocated memory, FrameFileWriter appends all frames to a file which
+can be opened again (memory-mapped) with FrameFile.
+"""
+
+import calendar
+import os
+import re
+import struct
+from datetime import datetime
+import numpy as np
+
+from waveform import Waveform
+
+MAGIC = b'MSOFRM\r\n'
+VERSION = 1
+HEADER_SIZE = 128
+_HEADER = struct.Struct('<8sHH4sQddddq16s')
+
+
+class FrameFileError(Exception):
+    """the file is not a valid frame file
+    """
+    pass
+
+
+# Parses the response of HORizontal:FASTframe:TIMEStamp:ALL:<wfm>? (e.g. "02 Mar 2020 10:10:10.123456789012", ...)
+# into nanoseconds since the epoch. The instrument clock has no time zone, so it is taken as UTC.
+def parse_timestamps(response):
+    stamps = re.findall(r'(\d{1,2} \w{3} \d{4} \d{1,2}:\d{2}:\d{2})(?:\.(\d+))?', response)
+    timestamps = np.empty(len(stamps), dtype=np.int64)
+    for i, (date, fraction) in enumerate(stamps):
+        seconds = calendar.timegm(datetime.strptime(date, '%d %b %Y %H:%M:%S').timetuple())
+        timestamps[i] = seconds * 1000000000 + int(fraction[:9].ljust(9, '0'))
+    return timestamps
+
+
+class FrameRingBuffer:
+    """Preallocated ring buffer holding the latest capacity frames
+
+    Once full, every new frame overwrites the oldest one. count is the total number of frames ever appended.
+    """
+
+    # constructor
+    def __init__(self, capacity, frame_length, dtype=np.int16):
+        self.capacity = capacity
+        self.frame_length = frame_length
+        self.frames = np.zeros((capacity, frame_length), dtype=dtype)
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+        self.preamble = None
+        self.channel = None
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def begin(self, preamble, frame_length, channel=None):
+        if frame_length != self.frame_length:
+            raise ValueError('Frame length {0} does not fit the ring buffer ({1}).'.format(frame_length,
+                                                                                         self.frame_length))
+        self.preamble = preamble
+        self.channel = channel
+
+    def append(self, frames, timestamps):
+        dropped = max(len(frames) - self.capacity, 0)  # older frames would be overwritten anyway
+        slots = (self.count + dropped + np.arange(len(frames) - dropped)) % self.capacity
+        self.frames[slots] = frames[dropped:]
+        self.timestamps[slots] = timestamps[dropped:]
+        self.count += len(frames)
+
+    # returns copies of the latest n frames and their timestamps in chronological order
+    def latest(self, n=None):
+        n = len(self) if n is None else min(n, len(self))
+        slots = (self.count - n + np.arange(n)) % self.capacity
+        return self.frames[slots], self.timestamps[slots]
+
+    def waveform(self, n=0):
+        # n-th latest frame (0 is the latest one)
+        slot = (self.count - 1 - n) % self.capacity
+        return Waveform.from_preamble(self.frames[slot], self.preamble, channel=self.channel,
+                                      timestamp=self.timestamps[slot] * 1e-9)
+
+
+def _record_dtype(dtype, frame_length):
+    return np.dtype([('timestamp', '<i8'), ('samples', np.dtype(dtype).newbyteorder('<'), (frame_length,))])
+
+
+class FrameFileWriter:
+    """Append-only frame file
+
+    Layout: a header with the scale factors followed by one record per frame (int64 timestamp in ns since the epoch,
+    raw samples). Appending to an existing file requires the same frame length, sample type, scale factors and
+    channel, as the frames are decoded with the header of the file.
+    """
+
+    # constructor
+    def __init__(self, filename, dtype=np.int16):
+        self.filename = filename
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.frame_length = None
+        self.__file = None
+
+    def begin(self, preamble, frame_length, channel=None):
+        if self.__file is None:
+            if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+                header = FrameFile(self.filename)
+                if header.frame_length != frame_length or header.dtype != self.dtype:
+                    raise FrameFileError('Frame length or sample type differ from the existing file.')
+                if (any(not np.isclose(header.preamble[key], preamble[key], rtol=1e-9, atol=0.0)
+                        for key in header.preamble) or header.channel != (channel or None)):
+                    raise FrameFileError('Scale factors or channel differ from the existing file.')
+                self.__file = open(self.filename, 'ab')
+            else:
+                self.__file = open(self.filename, 'wb')
+                header = _HEADER.pack(MAGIC, VERSION, HEADER_SIZE, self.dtype.str.encode('ascii'), frame_length,
+                                      preamble["y_mult"], preamble["y_zero"], preamble["x_incr"], preamble["x_zero"],
+                                      preamble["pt_off"], ('' if channel is None else channel).encode('ascii'))
+                self.__file.write(header.ljust(HEADER_SIZE, b'\0'))
+        self.frame_length = frame_length
+
+    def append(self, frames, timestamps):
+        records = np.empty(len(frames), dtype=_record_dtype(self.dtype, self.frame_length))
+        records['timestamp'] = timestamps
+        records['samples'] = frames
+        self.__file.write(records.tobytes())
+        self.__file.flush()
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FrameFile:
+    """Frame file opened for reading, the frames are memory-mapped"""
+
+    # constructor
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read(HEADER_SIZE)
+        if len(data) < _HEADER.size or not data.startswith(MAGIC):
+            raise FrameFileError('Not a frame file.')
+        (_, version, header_size, dtype, self.frame_length, y_mult, y_zero, x_incr, x_zero, pt_off,
+         channel) = _HEADER.unpack_from(data)
+        if version > VERSION:
+            raise FrameFileError('Frame file version {0} is not supported.'.format(version))
+        self.dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        self.preamble = {"y_mult": y_mult, "y_zero": y_zero, "x_incr": x_incr, "x_zero": x_zero, "pt_off": pt_off}
+        self.channel = channel.rstrip(b'\0').decode('ascii') or None
+        record_dtype = _record_dtype(self.dtype, self.frame_length)
+        n_frames = (os.path.getsize(filename) - header_size) // record_dtype.itemsize  # ignores a partial record
+        if n_frames > 0:
+            self.records = np.memmap(filename, dtype=record_dtype, mode='r', offset=header_size, shape=(n_frames,))
+        else:
+            self.records = np.empty(0, dtype=record_dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def frames(self):
+        return self.records['samples']
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    def waveform(self, index):
+        record = self.records[index]
+        return Waveform.from_preamble(record['samples'], self.preamble, channel=self.channel,
+                                      timestamp=int(record['timestamp']) * 1e-9)
@@ -0,0 +1,253 @@
+""" Waveform measurements computed on the raw integer codes, chunk by chunk.
+
+A MeasurementAccumulator is fed with the chunks of a transfer (e.g. from MSO54.open_waveform_stream()) and never
+converts more than a chunk at a time to floating point:
+
+- amplitude statistics (mean, RMS, min/max, peak-to-peak, top/base, overshoot/preshoot) come from a histogram of
+  the codes, which is exact for integer data and costs a single bincount per chunk,
+- edges are found with a 10 %/90 % hysteresis on the codes; they give rise/fall time (10-90 %) and, from the
+  50 % crossings of the rising edges, period and frequency. The reference levels have to be known while the
+  chunks arrive (levels=(base, top), e.g. from the previous acquisition), otherwise measure() derives them from
+  the histogram and runs a second pass over the raw codes,
+- the spectrum is a Welch estimate (Hann window, 50 % overlap) of the power spectral density, its strongest
+  component is reported as spectral peak.
+
+Float data (volts of earlier file versions, FLOAT transfers) is quantized to 2 byte codes spanning its value range
+first, i.e. with a resolution of 1/65534 of the range.
+
+Top and base are the most frequent codes in the upper and lower half of the histogram (like the MSO's "auto"
+method), the percentages refer to the amplitude top - base. All results are in V, s and Hz.
+"""
+
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 4194304  # samples
+DEFAULT_SPECTRUM_SIZE = 4096  # samples per Welch segment
+FLOAT_CODES = 65534  # steps of the 2 byte codes float data is quantized to
+_SEGMENT_BATCH = 256  # Welch segments transformed at once
+
+
+def _codes(dtype):
+    # histogram bin -> code for the unsigned view of the signed raw codes
+    bits = 8 * np.dtype(dtype).itemsize
+    codes = np.arange(2 ** bits, dtype=np.int64)
+    return np.where(codes < 2 ** (bits - 1), codes, codes - 2 ** bits)
+
+
+class MeasurementAccumulator:
+    """Measurements of one waveform fed chunk by chunk with update()"""
+
+    # constructor
+    # levels: (base, top) in V to detect edges while the chunks arrive; spectrum_size=None switches the FFT off
+    # value_range: (min, max) of float data (dtype float), which is quantized to 2 byte codes
+    def __init__(self, y_mult, y_zero=0.0, x_incr=1.0, dtype=np.int16, levels=None,
+                 spectrum_size=DEFAULT_SPECTRUM_SIZE, value_range=None):
+        self.y_mult = float(y_mult)
+        self.y_zero = float(y_zero)
+        self.x_incr = float(x_incr)
+        self.raw_dtype = np.dtype(dtype)
+        self.__center = self.__step = None
+        if self.raw_dtype.kind == 'f':
+            if value_range is None:
+                raise ValueError('Measurements of float data need its value range.')
+            low, high = map(float, value_range)
+            self.__center = (low + high) / 2
+            self.__step = (high - low) / FLOAT_CODES or 1.0
+            self.y_zero += self.y_mult * self.__center  # scale factors of the quantized codes
+            self.y_mult *= self.__step
+            dtype = np.int16
+        elif self.raw_dtype.kind != 'i' or self.raw_dtype.itemsize > 2:
+            raise ValueError('Measurements need 1 or 2 byte integer codes or float data.')
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.histogram = np.zeros(2 ** (8 * self.dtype.itemsize), dtype=np.int64)
+        self.spectrum_size = spectrum_size
+        self.__psd = None
+        self.__segments = 0
+        self.__spectrum_tail = np.empty(0, dtype=self.dtype)
+        self.__thresholds = None
+        self.__edges = {"rising_mid": [], "rise": [], "fall": []}
+        self.__edge_tail = np.empty(0, dtype=self.dtype)
+        self.__edge_offset = 0  # sample index of the first sample of the tail
+        if levels is not None:
+            self.set_levels(*levels)
+
+    @classmethod
+    def for_waveform(cls, waveform, **kwargs):
+        raw = waveform.raw
+        if raw.dtype.kind == 'f' and 'value_range' not in kwargs:
+            kwargs["value_range"] = (raw.min(), raw.max()) if len(raw) else (0.0, 0.0)
+        return cls(waveform.y_mult, waveform.y_zero, waveform.x_incr, raw.dtype, **kwargs)
+
+    def to_codes(self, volts):
+        return (np.asarray(volts, dtype=np.float64) - self.y_zero) / self.y_mult
+
+    def to_volts(self, codes):
+        return np.asarray(codes, dtype=np.float64) * self.y_mult + self.y_zero
+
+    # reference levels for the edge detection: low (10 %), mid (50 %) and high (90 %) between base and top
+    def set_levels(self, base, top):
+        base, top = self.to_codes((base, top))
+        if top < base:  # negative y_mult
+            base, top = top, base
+        self.__thresholds = tuple(base + fraction * (top - base) for fraction in (0.1, 0.5, 0.9))
+
+    def update(self, codes):
+        codes = np.asarray(codes)
+        if codes.dtype != self.raw_dtype:
+            raise ValueError('Chunk type {0} differs from {1}.'.format(codes.dtype, self.raw_dtype))
+        if self.__step is not None:
+            codes = np.rint((codes - self.__center) / self.__step).astype(self.dtype)
+        self.histogram += np.bincount(codes.view(self.dtype.str.replace('i', 'u')), minlength=len(self.histogram))
+        if self.__thresholds is not None:
+            self.__update_edges(codes)
+        if self.spectrum_size:
+            self.__update_spectrum(codes)
+        self.count += len(codes)
+
+    # edges
+    def __update_edges(self, codes):
+        samples = np.concatenate((self.__edge_tail, codes)) if len(self.__edge_tail) else codes
+        offset = self.__edge_offset
+        low, mid, high = self.__thresholds
+        is_low = samples <= low
+        is_high = samples >= high
+        classified = np.flatnonzero(is_low | is_high)
+        if len(classified) == 0:
+            self.__edge_tail = samples.copy()
+            self.__edge_offset = offset
+            return
+        state = is_high[classified]
+        change = np.flatnonzero(state[1:] != state[:-1])
+        start = classified[change]  # last sample beyond the threshold left
+        stop = classified[change + 1]  # first sample beyond the threshold reached
+        rising = state[change + 1]
+
+        def values(index):
+            return samples[index].astype(np.float64)
+
+        for direction, first, last in ((True, start[rising], stop[rising]), (False, start[~rising], stop[~rising])):
+            if len(first) == 0:
+                continue
+            begin_level, end_level = (low, high) if direction else (high, low)
+            t_begin = first + (begin_level - values(first)) / (values(first + 1) - values(first))
+            t_end = last - 1 + (end_level - values(last - 1)) / (values(last) - values(last - 1))
+            self.__edges["rise" if direction else "fall"].append(t_end - t_begin)
+            if direction:
+                above_mid = samples >= mid
+                crossings = np.flatnonzero(above_mid[1:] & ~above_mid[:-1])  # mid crossed between i and i + 1
+                crossing = crossings[np.searchsorted(crossings, first)]
+                t_mid = crossing + (mid - values(crossing)) / (values(crossing + 1) - values(crossing))
+                self.__edges["rising_mid"].append(offset + t_mid)
+        # everything from the last classified sample on is needed to detect an edge across the chunk border
+        self.__edge_tail = samples[classified[-1]:].copy()
+        self.__edge_offset = offset + classified[-1]
+
+    # spectrum
+    def __update_spectrum(self, codes):
+        n = self.spectrum_size
+        step = n // 2
+        samples = np.concatenate((self.__spectrum_tail, codes)) if len(self.__spectrum_tail) else codes
+        n_segments = (len(samples) - n) // step + 1 if len(samples) >= n else 0
+        if n_segments > 0:
+            if self.__psd is None:
+                self.__psd = np.zeros(n // 2 + 1, dtype=np.float64)
+            window = np.hanning(n).astype(np.float32)
+            segments = np.lib.stride_tricks.sliding_window_view(samples, n)[::step][:n_segments]
+            for first in range(0, n_segments, _SEGMENT_BATCH):
+                batch = segments[first:first + _SEGMENT_BATCH].astype(np.float32)
+                batch -= batch.mean(axis=1, keepdims=True)
+                batch *= window
+                self.__psd += (np.abs(np.fft.rfft(batch, axis=1)) ** 2).sum(axis=0)
+            self.__segments += n_segments
+        self.__spectrum_tail = samples[n_segments * step:].copy()
+
+    def spectrum(self):
+        # frequencies in Hz and one-sided power spectral density in V^2/Hz (None before the first full segment)
+        if self.__psd is None:
+            return None, None
+        n = self.spectrum_size
+        window = np.hanning(n)
+        psd = self.__psd * self.y_mult ** 2 / (self.__segments * np.sum(window ** 2) / self.x_incr)
+        psd[1:-1] *= 2
+        return np.fft.rfftfreq(n, self.x_incr), psd
+
+    # results
+    def levels(self):
+        # base and top in V from the histogram: most frequent code in the lower and upper half of the range
+        codes = _codes(self.dtype)
+        present = np.flatnonzero(self.histogram)
+        order = np.argsort(codes[present])
+        present = present[order]
+        low, high = codes[present[0]], codes[present[-1]]
+        middle = (low + high) / 2
+        lower = present[codes[present] <= middle]
+        upper = present[codes[present] > middle] if high > low else lower
+        base = codes[lower[np.argmax(self.histogram[lower])]]
+        top = codes[upper[np.argmax(self.histogram[upper])]]
+        return tuple(sorted(self.to_volts((base, top))))
+
+    def result(self):
+        if self.count == 0:
+            raise ValueError('No samples measured.')
+        codes = _codes(self.dtype)
+        weights = self.histogram / self.count
+        mean_code = np.dot(weights, codes)
+        square_code = np.dot(weights, codes.astype(np.float64) ** 2)
+        present = codes[np.flatnonzero(self.histogram)]
+        minimum, maximum = sorted(self.to_volts((present.min(), present.max())))
+        base, top = self.levels()
+        amplitude = top - base
+        mean = mean_code * self.y_mult + self.y_zero
+        rms = np.sqrt(max(self.y_mult ** 2 * square_code + 2 * self.y_mult * self.y_zero * mean_code
+                          + self.y_zero ** 2, 0.0))
+        result = {"count": self.count,
+                  "mean": mean,
+                  "rms": rms,
+                  "ac_rms": np.sqrt(max(rms ** 2 - mean ** 2, 0.0)),
+                  "min": minimum,
+                  "max": maximum,
+                  "peak_to_peak": maximum - minimum,
+                  "top": top,
+                  "base": base,
+                  "amplitude": amplitude,
+                  "overshoot": 100 * (maximum - top) / amplitude if amplitude > 0 else np.nan,
+                  "preshoot": 100 * (base - minimum) / amplitude if amplitude > 0 else np.nan}
+        result.update(self.timing())
+        result["frequencies"], result["psd"] = self.spectrum()
+        # strongest component apart from DC
+        result["spectral_peak"] = (result["frequencies"][1 + np.argmax(result["psd"][1:])]
+                                   if result["psd"] is not None and len(result["psd"]) > 1 else np.nan)
+        return result
+
+    def timing(self):
+        rising_mid = np.concatenate(self.__edges["rising_mid"]) if self.__edges["rising_mid"] else np.empty(0)
+        rise = np.concatenate(self.__edges["rise"]) if self.__edges["rise"] else np.empty(0)
+        fall = np.concatenate(self.__edges["fall"]) if self.__edges["fall"] else np.empty(0)
+        period = np.mean(np.diff(rising_mid)) * self.x_incr if len(rising_mid) > 1 else np.nan
+        return {"period": period,
+                "frequency": 1 / period if period > 0 else np.nan,
+                "rise_time": np.mean(rise) * self.x_incr if len(rise) else np.nan,
+                "fall_time": np.mean(fall) * self.x_incr if len(fall) else np.nan,
+                "rising_edges": len(rise),
+                "falling_edges": len(fall)}
+
+
+# Measures a waveform.Waveform (also memory-mapped ones) chunk by chunk. Without levels the histogram is taken
+# first and the edges are detected in a second pass over the raw codes.
+def measure(waveform, levels=None, chunk_size=DEFAULT_CHUNK_SIZE, spectrum_size=DEFAULT_SPECTRUM_SIZE):
+    accumulator = MeasurementAccumulator.for_waveform(waveform, levels=levels, spectrum_size=spectrum_size)
+    for start in range(0, len(waveform.raw), chunk_size):
+        accumulator.update(waveform.raw[start:start + chunk_size])
+    result = accumulator.result()
+    if levels is None:
+        result.update(timing(waveform, accumulator.levels(), chunk_size))
+    return result
+
+
+# period, frequency, rise and fall time of a waveform for the given levels (base, top in V)
+def timing(waveform, levels, chunk_size=DEFAULT_CHUNK_SIZE):
+    accumulator = MeasurementAccumulator.for_waveform(waveform, levels=levels, spectrum_size=None)
+    for start in range(0, len(waveform.raw), chunk_size):
+        accumulator.update(waveform.raw[start:start + chunk_size])
+    return accumulator.timing()
@@ -1,8 +1,16 @@
 import numpy as np
 from enum import Enum
+import queue
 import sys
+import threading
+from time import monotonic
+from time import time
 
+import measure
 import mso54 as analyzer
+import regions
+from buffer_pool import BufferPool
+from waveform import Waveform
 
 
 class State(Enum):
@@ -12,19 +20,90 @@ class State(Enum):
 
 
 class Model:
+    HEARTBEAT_INTERVAL = 1.0  # s, minimum time without any instrument I/O before the connection is checked again
+    MAX_RECONNECT_INTERVAL = 30.0  # s, the interval between connection attempts doubles up to this value
+    MAX_REGION_SAMPLES = regions.MAX_REGION_SAMPLES  # wider zoomed ranges are shown from the overview
 
     # constructor & destructor
-    def __init__(self):
-        self.instrument = analyzer.MSO54()
+    # instrument defaults to an MSO54 found by the automatic search (see also session.Session for several ones)
+    def __init__(self, instrument=None):
+        self.instrument = analyzer.MSO54() if instrument is None else instrument
         self._observers = set()
+        # all instrument I/O is done by the worker thread, results and notifications are handed over to the
+        # dispatcher which has to call them in the GUI thread (see set_dispatcher())
+        self._dispatch = self.__call_directly
+        self.__io_lock = threading.RLock()
+        self.__commands = queue.Queue()
+        self.__idle = True
+        self.__last_io = 0.0
+        self.__reconnect_interval = self.HEARTBEAT_INTERVAL
+        self.__next_connect = 0.0
+        self.__continuous = threading.Event()
+        self.__free_buffers = queue.Queue()
         self.state = State.DISCONNECTED
         self.available_channels = None
+        self.buffer_pool = BufferPool()  # raw data buffers of transfer_waveforms(), see release_waveforms()
+        self.last_transfer_io = None  # I/O totals of the last transfer_waveforms() (see tracing.IOStatistics)
+        self.region_cache = regions.RegionCache()  # full resolution regions of the last overview
+        self.__regions = []  # regions.RecordRegions per channel of the last overview
+        self.__worker = threading.Thread(target=self.__worker_routine, name='instrument I/O', daemon=True)
+        self.__worker.start()
 
     def __del__(self):
         pass
 
+    def close(self):
+        self.stop_continuous()  # otherwise the worker would never get to the stop command
+        self.__commands.put(None)  # stops the worker after all pending commands
+        self.__worker.join(timeout=5.0)
+        with self.__io_lock:
+            self.instrument.disconnect()
+
+    def set_dispatcher(self, dispatch):
+        self._dispatch = dispatch
+
+    # worker thread methods
+    # Queues func(*args) for execution in the worker thread. on_done(result) or on_error(error) is then called via
+    # the dispatcher.
+    def submit(self, func, *args, on_done=None, on_error=None):
+        self.__commands.put((func, args, on_done, on_error))
+
+    def __worker_routine(self):
+        while True:
+            command = self.__commands.get()
+            if command is None:
+                break
+            func, args, on_done, on_error = command
+            self.__idle = False
+            try:
+                with self.__io_lock:
+                    result = func(*args)
+            except Exception as error:
+                if on_error is None:
+                    print('Error in instrument worker: {0}'.format(error), file=sys.stderr)
+                else:
+                    self._dispatch(lambda on_error=on_error, error=error: on_error(error))
+            else:
+                if on_done is not None:
+                    self._dispatch(lambda on_done=on_done, result=result: on_done(result))
+            finally:
+                self.__last_io = monotonic()
+                self.__idle = self.__commands.empty()
+
+    @staticmethod
+    def __call_directly(func):
+        func()
+
     # model specific methods
+    # called periodically by the GUI; the connection check is only queued if the bus has been idle for a while
     def timer_routine(self):
+        if self.state is State.DISCONNECTED and monotonic() < self.__next_connect:
+            return  # back off between connection attempts
+        if self.__idle and self.__commands.empty() and monotonic() - self.__last_io >= self.HEARTBEAT_INTERVAL:
+            self.__idle = False
+            self.submit(self.__heartbeat)
+
+    def __heartbeat(self):
         # print('timer routine called')
         if self.state is not State.CONNECTED:
             try:
@@ -35,26 +114,202 @@ class Model:
             except analyzer.WrongInstrumentError:
                 print('WrongInstrumentError')
                 pass
-        if self.instrument.is_connected():
+        channels = self.instrument.poll_available_channels()
+        if channels is not None:
+            self.available_channels = channels
+            self.__reconnect_interval = self.HEARTBEAT_INTERVAL
             self.state = State.CONNECTED
-            self.available_channels = self.instrument.get_available_channels()
         else:
+            self.__next_connect = monotonic() + self.__reconnect_interval
+            self.__reconnect_interval = min(2 * self.__reconnect_interval, self.MAX_RECONNECT_INTERVAL)
             self.state = State.DISCONNECTED
         # self.instrument.acquire_single_sequence(wait_for_completion=True)
 
-
     def data(self, channel):
         if self.state == State.CONNECTED:
+            with self.__io_lock:
+                self.state = State.BUSY
+                try:
+                    return self.instrument.transfer_waveform(channel)
+                except analyzer.VisaError as error:
+                    print('VISA error: {0}'.format(error))
+                finally:
+                    self.state = State.CONNECTED
+        else:
+            return None
+
+    # fetches the data in the worker thread and hands the result (see data()) over to on_done
+    def request_data(self, channel, on_done, on_error=None):
+        self.submit(self.data, channel, on_done=on_done, on_error=on_error)
+
+    # fetches several channels of the same acquisition, returns a list of waveforms in the order of channels
+    def transfer_waveforms(self, channels):
+        if self.state == State.CONNECTED:
+            with self.__io_lock:
+                self.state = State.BUSY
+                before = self.instrument.io_statistics.totals()
+                self.__regions = []  # a new read replaces the record explored in interactive mode
+                self.region_cache.clear()
+                try:
+                    return self.instrument.transfer_waveforms(channels, pool=self.buffer_pool)
+                except analyzer.VisaError as error:
+                    print('VISA error: {0}'.format(error))
+                finally:
+                    after = self.instrument.io_statistics.totals()
+                    self.last_transfer_io = {key: after[key] - before[key] for key in after}
+                    self.state = State.CONNECTED
+        else:
+            return None
+
+    def request_waveforms(self, channels, on_done, on_error=None):
+        self.submit(self.transfer_waveforms, channels, on_done=on_done, on_error=on_error)
+
+    # Interactive mode, step 1: fetches a coarse overview of the channels (see MSO54.transfer_overview()) and prepares
+    # the full resolution access to their records (see regions). If the instrument cannot reduce the resolution, the
+    # samples around the trigger are fetched at full resolution instead. Returns a list of waveforms in the order of
+    # channels. The instrument should not acquire while the record is explored with transfer_region().
+    def transfer_overview(self, channels):
+        if self.state == State.CONNECTED:
+            with self.__io_lock:
+                self.state = State.BUSY
+                self.region_cache.clear()
+                try:
+                    encoding = self.instrument.resolve_encoding(integer=True)
+                    timestamp = time()
+                    self.__regions = [regions.RecordRegions(self.instrument, channel, encoding, self.region_cache,
+                                                            timestamp) for channel in channels]
+                    waveforms = []
+                    for record in self.__regions:
+                        overview = self.instrument.transfer_overview(record.channel, encoding)
+                        waveforms.append(record.read_around_trigger(self.MAX_REGION_SAMPLES) if overview is None
+                                         else overview)
+                    return waveforms
+                except analyzer.VisaError as error:
+                    print('VISA error: {0}'.format(error))
+                finally:
+                    self.state = State.CONNECTED
+        else:
+            return None
+
+    def request_overview(self, channels, on_done, on_error=None):
+        self.submit(self.transfer_overview, channels, on_done=on_done, on_error=on_error)
+
+    # Interactive mode, step 2: the time range of the channels of the last overview at full resolution. Only the
+    # blocks which are not in the region cache are fetched. Returns None without any I/O if the range spans more
+    # than MAX_REGION_SAMPLES samples (the overview is good enough then).
+    def transfer_region(self, t_start, t_stop):
+        if self.state != State.CONNECTED or not self.__regions:
+            return None
+        spans = [record.index_range(t_start, t_stop) for record in self.__regions]
+        if any(stop - start > self.MAX_REGION_SAMPLES or stop <= start for start, stop in spans):
+            return None
+        with self.__io_lock:
+            self.state = State.BUSY
             try:
-                time, data, sample_period = self.instrument.transfer_waveform(channel)
-                return {"time": time,
-                        "data": data,
-                        "sample_period": sample_period}
+                return [record.read(start, stop) for record, (start, stop) in zip(self.__regions, spans)]
             except analyzer.VisaError as error:
                 print('VISA error: {0}'.format(error))
+            finally:
+                self.state = State.CONNECTED
+
+    def request_region(self, t_start, t_stop, on_done, on_error=None):
+        self.submit(self.transfer_region, t_start, t_stop, on_done=on_done, on_error=on_error)
+
+    # Transfers the channel chunk by chunk and measures every chunk as soon as it has arrived (see measure), so the
+    # results are ready right after the transfer. Without levels (base, top in V) the edges are detected in a second
+    # pass over the raw codes. Returns the waveform and the measurement results.
+    def measure(self, channel, levels=None):
+        if self.state == State.CONNECTED:
+            with self.__io_lock:
+                self.state = State.BUSY
+                try:
+                    stream = self.instrument.open_waveform_stream(channel)
+                    raw = np.empty(stream.n_samples, dtype=stream.dtype)
+                    preamble = stream.preamble
+                    accumulator = measure.MeasurementAccumulator(preamble["y_mult"], preamble["y_zero"],
+                                                                 preamble["x_incr"], stream.dtype, levels=levels)
+                    for offset, chunk in stream:
+                        raw[offset:offset + len(chunk)] = chunk
+                        accumulator.update(chunk)
+                finally:
+                    self.state = State.CONNECTED
+            waveform = Waveform.from_preamble(raw, preamble, channel=channel, timestamp=time())
+            results = accumulator.result()
+            if levels is None:
+                results.update(measure.timing(waveform, accumulator.levels()))
+            return waveform, results
         else:
             return None
 
+    # trigger settings of the instrument (see MSO54.get_trigger_settings()), queried only where they are stored
+    def trigger_settings(self):
+        if self.state == State.CONNECTED:
+            with self.__io_lock:
+                return self.instrument.get_trigger_settings()
+        else:
+            return None
+
+    def request_trigger_settings(self, on_done, on_error=None):
+        self.submit(self.trigger_settings, on_done=on_done, on_error=on_error)
+
+    # measures waveforms which have been read or imported already, returns a list of result dicts
+    def measure_waveforms(self, waveforms):
+        return [measure.measure(waveform) for waveform in waveforms]
+
+    def request_measurements(self, waveforms, on_done, on_error=None):
+        self.submit(self.measure_waveforms, waveforms, on_done=on_done, on_error=on_error)
+
+    # hands the buffers of waveforms from transfer_waveforms() back for the next transfer (others are ignored)
+    def release_waveforms(self, waveforms):
+        for waveform in waveforms or []:
+            if isinstance(waveform, Waveform):  # digital waveforms are packed into their own arrays
+                self.buffer_pool.release(waveform.raw)
+
+    # Acquires and transfers the channel repeatedly until stop_continuous() is called. Every frame is handed over to
+    # on_frame as dict with the waveform and the time spent for acquisition and transfer. Two buffers are used
+    # alternately: the next frame is fetched while the previous one is shown, its buffer has to be handed back
+    # with release_frame() when it is not needed anymore.
+    def start_continuous(self, channel, on_frame, on_error=None):
+        self.__continuous.set()
+        self.submit(self.__continuous_routine, channel, on_frame, on_error=on_error)
+
+    def stop_continuous(self):
+        self.__continuous.clear()
+
+    def release_frame(self, frame):
+        self.__free_buffers.put(frame["buffer"])
+
+    def __continuous_routine(self, channel, on_frame):
+        if self.state is not State.CONNECTED:
+            self.__continuous.clear()
+            return
+        self.__free_buffers = queue.Queue()
+        for _ in range(2):
+            self.__free_buffers.put(np.empty(0, dtype=np.int16))
+        self.state = State.BUSY
+        try:
+            while self.__continuous.is_set():
+                try:
+                    buffer = self.__free_buffers.get(timeout=0.1)
+                except queue.Empty:  # both buffers are still in use by the GUI
+                    continue
+                t_start = monotonic()
+                self.instrument.acquire_single_sequence(wait_for_completion=True)
+                record_length = self.instrument.get_record_length()
+                encoding = self.instrument.resolve_encoding(integer=True)
+                dtype = np.dtype(self.instrument.ENCODING_FORMATS[encoding][3])
+                if len(buffer) != record_length or buffer.dtype != dtype:
+                    buffer = np.empty(record_length, dtype=dtype)
+                waveform = self.instrument.transfer_waveform_into(channel, buffer, chunk_size=record_length,
+                                                                  record_length=record_length, encoding=encoding)
+                frame = {"waveform": waveform,
+                         "buffer": buffer,
+                         "transfer_time": monotonic() - t_start}
+                self._dispatch(lambda frame=frame: on_frame(frame))
+        finally:
+            self.__continuous.clear()
+            self.state = State.CONNECTED
+
     # observer pattern methods
     def attach(self, observer):
         self._observers.add(observer)
@@ -63,12 +318,17 @@ class Model:
         self._observers.discard(observer)
 
     def __notify(self):
+        state = self.__state
         for observer in self._observers:
-            observer.update(self.__state)
+            self._dispatch(lambda observer=observer: observer.update(state))
 
     def get_available_channels(self):
         return self.available_channels
 
+    # True for the logic sources (e.g. CH4_DALL), which are transferred bit-packed (see digital)
+    def is_digital(self, channel):
+        return self.instrument.get_wave_type(channel) is analyzer.WaveType.DIGITAL
+
     @property
     def state(self):
         return self.__state
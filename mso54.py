@@ -5,11 +5,23 @@ Currently only a small subset of commands is implemented. Feel free to add some
 "5 Series MSO MSO54, MSO56, MSO58, MSO58LP ZZZ Programmer Manual"
 """
 
+import asyncio
+import ctypes
+import os
 import numpy as np
 from enum import Enum
 from enum import unique
 import pyvisa as visa
-from time import sleep
+import re
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from time import time
+
+import capture_file
+from digital import DigitalWaveform
+import fastframe
+import tracing
+from waveform import Waveform
 
 
 class NoConnectionError(Exception):
@@ -41,6 +53,14 @@ class VisaError(Exception):
     pass
 
 
+class AcquisitionTimeoutError(Exception):
+    """the acquisition did not complete within the given time
+
+    Usually the trigger conditions have not been met. The acquisition is still armed on the instrument.
+    """
+    pass
+
+
 @unique
 class WaveType(Enum):
     ANALOG = 1
@@ -48,10 +68,48 @@ class WaveType(Enum):
     MATH = 3
 
 
+# Transfer encoding policy: AUTO picks 1 byte codes only where they are lossless, i.e. for an ADC with at most 8
+# bits in an acquisition mode which does not add resolution, otherwise 2 bytes. The others force 1 or 2 byte
+# integers or 4 byte floats.
+@unique
+class Encoding(Enum):
+    AUTO = 'auto'
+    INT8 = 'int8'
+    INT16 = 'int16'
+    FLOAT = 'float'
+
+
 class MSO54:
     # constants
     # NAME = 'MSO54'
     NAME = 'MSO'
+    DEFAULT_CHUNK_SIZE = 1000000  # samples per CURVe? query in chunked transfers (2 MB with 2 byte encoding)
+    READ_CHUNK_SIZE = 4194304  # bytes per raw read while receiving a data block
+    DEFAULT_ACQUISITION_TIMEOUT = 10.0  # s, maximum time to wait for a triggered acquisition
+    PROBE_TIMEOUT = 500  # ms, I/O timeout while searching for the instrument
+    MAX_PARALLEL_PROBES = 8
+    MULTI_SOURCE_CURVE = None  # CURVe? with several sources at once: None -> detect, True/False -> force
+    REDUCED_RESOLUTION = None  # DATa:RESOlution REDUced for overviews: None -> detect, True/False -> force
+    DEFAULT_ENCODING = Encoding.AUTO
+    # prefixes of the ACQuire:MODe? responses whose samples have the resolution of the ADC (HIRes and AVErage add bits)
+    ONE_BYTE_ACQUISITION_MODES = ('SAM', 'PEAK')
+    # bits of the ADC: None -> by the model in the *IDN? response (models not listed are assumed to need 2 bytes)
+    ADC_BITS = None
+    ADC_BITS_BY_MODEL = (('MSO2', 8), ('MSO4', 12), ('MSO5', 12), ('MSO6', 12))
+    # DATa:ENCdg, WFMOutpre:BYT_Nr, query_binary_values datatype and numpy dtype per transfer encoding
+    ENCODING_FORMATS = {Encoding.INT8: ('SRIbinary', 1, 'b', '<i1'),  # SRIbinary -> little endian
+                        Encoding.INT16: ('SRIbinary', 2, 'h', '<i2'),
+                        Encoding.FLOAT: ('SFPbinary', 4, 'f', '<f4')}
+    # digital sources (CHx_DALL, CHx_Dn): one unsigned byte per sample, bit n of CHx_DALL is lane Dn
+    DIGITAL_FORMAT = ('SRPbinary', 1, 'B', '<u1')
+    DIGITAL_LANES = 8
+    LAST_ADDRESS_FILE = os.path.join(os.path.expanduser('~'), '.tektronix_mso_lab_address')
+    TRACE_IO = True  # record every VISA call in io_statistics (see tracing)
+
+    # fields of the WFMOutpre? response in the order given by the programmer manual
+    PREAMBLE_FIELDS = ('byt_nr', 'bit_nr', 'encdg', 'bn_fmt', 'byt_or', 'wfid', 'nr_pt', 'pt_fmt', 'pt_order',
+                       'x_unit', 'x_incr', 'x_zero', 'pt_off', 'y_unit', 'y_mult', 'y_off', 'y_zero', 'domain',
+                       'wfmtype', 'centerfrequency', 'span', 'reflevel')
 
     # TRACE_A_CMD = 'XMA? 0,'
     # TRACE_B_CMD = 'XMB? 0,'
@@ -59,10 +117,20 @@ class MSO54:
     # NUMBER_OF_POINTS_CMD = 'MEP?'
 
     # constructor & destructor
-    def __init__(self, visa_address=None):
-        self.__visa_manager = visa.ResourceManager()
+    # resource_manager can replace the VISA resource manager, e.g. by sim_mso.SimulatedResourceManager
+    def __init__(self, visa_address=None, resource_manager=None):
+        self.__visa_manager = visa.ResourceManager() if resource_manager is None else resource_manager
         self.__visa_address = visa_address
         self._inst = None
+        self.__settings = {}  # write-through cache of the transfer settings (command -> value)
+        self.__available_channels = None
+        self.__srq_enabled = False
+        self.__multi_source_curve = self.MULTI_SOURCE_CURVE
+        self.__reduced_resolution = self.REDUCED_RESOLUTION
+        self.__adc_bits = self.ADC_BITS
+        self.io_statistics = tracing.IOStatistics()
+        self.encoding = self.DEFAULT_ENCODING
+        self.last_transfer = None  # encoding, samples, bytes and throughput of the last transfer
 
     def __del__(self):
         pass
@@ -70,11 +138,12 @@ class MSO54:
     # VISA methods
     # connect to instrument (either by direct addressing or an automatic search)
     def connect(self):
+        self.invalidate_settings_cache()  # the instrument might have been reset or replaced in the meantime
         if self.__visa_address is None:
             self._search_instrument()
         else:
             try:
-                self._inst = self.__visa_manager.open_resource(self.__visa_address)
+                self._inst = self._traced(self.__visa_manager.open_resource(self.__visa_address))
                 self._inst.write('*cls')  # clear Standard Event Status Register red with "*ESR?"
             except visa.errors.VisaIOError:
                 raise NoConnectionError('Cannot connect to instrument. Check VISA driver and/or connections.')
@@ -83,32 +152,74 @@ class MSO54:
                     self.disconnect()
                     raise WrongInstrumentError('Wrong VISA address. This is not the ' + self.NAME + '.')
 
-    # automatic search for the MSO54 within the connected VISA instruments
+    # Automatic search for the MSO54 within the connected VISA instruments. The last address an instrument has been
+    # found at is tried first, otherwise all USB instruments are probed concurrently with a short timeout.
     def _search_instrument(self):
-        instruments = self.__visa_manager.list_resources()
-        candidate = None
-        for instrument in instruments:
-            try:
-                candidate = self.__visa_manager.open_resource(instrument)
-            except visa.errors.VisaIOError:
-                continue
-            if candidate.interface_type == visa.constants.InterfaceType.usb:
-                try:
-                    if self.NAME.lower() not in candidate.query("*IDN?").lower():
-                        candidate = None  # no, that's not our instrument
-                    else:
-                        break  # great, we found our instrument
-                except visa.VisaIOError:
-                    candidate = None
-            else:
-                candidate.close()
-                candidate = None
-        if candidate is None:
+        last_address = self._load_last_address()
+        if last_address is not None:
+            candidate = self._probe_instrument(last_address)
+            if candidate is not None:
+                self._inst = self._traced(candidate)
+                return
+        try:
+            instruments = [instrument for instrument in self.__visa_manager.list_resources()
+                           if instrument != last_address and self._is_search_candidate(instrument)]
+        except visa.errors.VisaIOError:
+            instruments = []
+        candidates = []
+        if instruments:
+            with ThreadPoolExecutor(max_workers=min(len(instruments), self.MAX_PARALLEL_PROBES)) as pool:
+                candidates = [candidate for candidate in pool.map(self._probe_instrument, instruments)
+                              if candidate is not None]
+        if not candidates:
             raise NoConnectionError('Cannot connect to instrument. Check VISA driver and/or connections.')
-        else:
-            self._inst = candidate
+        self._inst = self._traced(candidates[0])  # great, we found our instrument
+        for candidate in candidates[1:]:
+            candidate.close()
+        self._save_last_address(self._inst.resource_name)
+
+    def _traced(self, resource):
+        return tracing.TracedResource(resource, self.io_statistics) if self.TRACE_IO else resource
+
+    def _is_search_candidate(self, instrument):
+        try:
+            return self.__visa_manager.resource_info(instrument).interface_type == visa.constants.InterfaceType.usb
+        except (visa.errors.VisaIOError, ValueError):
+            return instrument.upper().startswith('USB')
+
+    # opens the resource and returns it if it is our instrument, otherwise it is closed again and None is returned
+    def _probe_instrument(self, instrument):
+        try:
+            candidate = self.__visa_manager.open_resource(instrument, open_timeout=self.PROBE_TIMEOUT)
+        except visa.errors.VisaIOError:
+            return None
+        try:
+            io_timeout = candidate.timeout
+            candidate.timeout = self.PROBE_TIMEOUT
+            if self.NAME.lower() in candidate.query("*IDN?").lower():
+                candidate.timeout = io_timeout
+                return candidate
+        except visa.errors.VisaIOError:
+            pass
+        candidate.close()  # no, that's not our instrument
+        return None
+
+    def _load_last_address(self):
+        try:
+            with open(self.LAST_ADDRESS_FILE, 'r') as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _save_last_address(self, address):
+        try:
+            with open(self.LAST_ADDRESS_FILE, 'w') as f:
+                f.write(address)
+        except OSError:
+            pass
 
     def disconnect(self):
+        self.invalidate_settings_cache()
         try:
             self._inst.close()
         except AttributeError:  # raised when no instrument connected beforehand (what's just fine)
@@ -127,94 +238,534 @@ class MSO54:
                 return False
         pass
 
+    # The transfer settings (DATa:*, WFMOutpre:BYT_Nr) are only changed by this driver, so they are cached and
+    # written through only when they change. The cache has to be invalidated whenever the instrument state might
+    # have been changed otherwise, e.g. by *RST or a reconnect.
+    def _write_cached(self, command, value):
+        value = str(value)
+        if self.__settings.get(command) != value:
+            self._inst.write(command + ' ' + value)
+            self.__settings[command] = value
+
+    def invalidate_settings_cache(self):
+        self.__settings = {}
+        self.__available_channels = None
+        self.__multi_source_curve = self.MULTI_SOURCE_CURVE
+        self.__reduced_resolution = self.REDUCED_RESOLUTION
+        self.__adc_bits = self.ADC_BITS
+
+    # cheap connection check (a single query) which updates the list of available channels at the same time
+    def poll_available_channels(self):
+        if self._inst is None:
+            return None
+        try:
+            return self.get_available_channels()
+        except visa.errors.Error:  # VisaIOError or InvalidSession (closed beforehand)
+            return None
+
+    # I/O statistics per SCPI command (count, errors, bytes, latency histogram), see tracing.IOStatistics
+    def get_io_stats(self):
+        return self.io_statistics.stats()
+
+    def reset_io_stats(self):
+        self.io_statistics.reset()
+
+    # writes the statistics as JSON or the latest calls in the Chrome trace event format (trace_format='chrome')
+    def export_io_trace(self, filename, trace_format='json'):
+        if trace_format == 'chrome':
+            self.io_statistics.export_chrome_trace(filename)
+        else:
+            self.io_statistics.export_json(filename)
+
     # instrument specific commands
+    def reset(self):
+        self._inst.write('*RST')
+        self.invalidate_settings_cache()
+
     def clear_SESR_EventQueue_StatusByteReg(self):
         self._inst.write('*CLS')
 
     # this is the same as pushing the "Single/Seq" button on the instrument
-    def acquire_single_sequence(self, wait_for_completion=False):
+    def acquire_single_sequence(self, wait_for_completion=False, timeout=None):
+        self.arm_single_sequence(notify=wait_for_completion)
+        if wait_for_completion:
+            self.wait_for_acquisition(timeout)
+
+    # Starts a single sequence acquisition. With notify=True the completion is signalled by *OPC, which sets the
+    # OPC bit in the SESR (DESE/*ESE 1) and in turn requests service via the ESB bit (*SRE 32).
+    def arm_single_sequence(self, notify=True):
         if (self._inst.query('ACQuire:STOPAfter?').lower().strip() != "sequence"):
             self._inst.write('ACQuire:STOPAfter SEQuence')  # sets instrument to single sequence mode
-        if wait_for_completion:
-            self._inst.write('DESE 1')
-            self._inst.write('*ESE 1')
-            self._inst.write('*SRE 0')
+        if notify:
+            self._write_cached('DESE', 1)
+            self._write_cached('*ESE', 1)
+            self._write_cached('*SRE', 32)
+            self.__srq_enabled = self._enable_srq_event()
+            self.clear_SESR_EventQueue_StatusByteReg()
             self._inst.write('ACQUIRE:STATE ON')  # activates a new single shot acquisition
             self._inst.write('*OPC')
-            i = 0
-            while int(self._inst.query('*ESR?')) != 1:
-                sleep(0.1)
-                i = i + 1
-                assert i < 100, "timeout while waiting for acquisition completion"
         else:
             self._inst.write('ACQUIRE:STATE ON')  # activates a new single shot acquisition
 
+    # Blocks until the acquisition started by arm_single_sequence(notify=True) is complete. The service request is
+    # awaited where the interface supports it, otherwise *OPC? is used with a temporarily raised I/O timeout.
+    def wait_for_acquisition(self, timeout=None):
+        if timeout is None:
+            timeout = self.DEFAULT_ACQUISITION_TIMEOUT
+        timeout_ms = int(timeout * 1000)
+        if self.__srq_enabled:
+            try:
+                self._inst.wait_on_event(visa.constants.EventType.service_request, timeout_ms)
+            except visa.errors.VisaIOError as error:
+                if error.error_code != visa.constants.StatusCode.error_timeout:
+                    raise
+                raise AcquisitionTimeoutError('Acquisition not completed within {0} s.'.format(timeout))
+            finally:
+                self._disable_srq_event()
+            self._inst.query('*ESR?')  # reading the SESR clears the ESB bit and with it the service request
+        else:
+            io_timeout = self._inst.timeout
+            self._inst.timeout = timeout_ms
+            try:
+                self._inst.query('*OPC?')
+            except visa.errors.VisaIOError as error:
+                if error.error_code != visa.constants.StatusCode.error_timeout:
+                    raise
+                self._inst.clear()  # discard the pending *OPC? response
+                raise AcquisitionTimeoutError('Acquisition not completed within {0} s.'.format(timeout))
+            finally:
+                self._inst.timeout = io_timeout
+
+    # awaitable variant of acquire_single_sequence(wait_for_completion=True), e.g. to arm several instruments and
+    # wait for all of them concurrently
+    async def acquire_single_sequence_async(self, timeout=None):
+        self.arm_single_sequence(notify=True)
+        await asyncio.get_running_loop().run_in_executor(None, self.wait_for_acquisition, timeout)
+
+    def _enable_srq_event(self):
+        if self._inst.interface_type not in (visa.constants.InterfaceType.usb, visa.constants.InterfaceType.gpib):
+            return False
+        try:
+            self._inst.enable_event(visa.constants.EventType.service_request, visa.constants.EventMechanism.queue)
+        except visa.errors.VisaIOError:  # service requests are not supported by this VISA session
+            return False
+        return True
+
+    def _disable_srq_event(self):
+        self.__srq_enabled = False
+        try:
+            self._inst.disable_event(visa.constants.EventType.service_request, visa.constants.EventMechanism.queue)
+            self._inst.discard_events(visa.constants.EventType.service_request, visa.constants.EventMechanism.queue)
+        except visa.errors.VisaIOError:
+            pass
+
     def get_record_length(self):
         return int(self._inst.query('HORizontal:RECORDLength?').split(' ')[-1])
 
+    # Settings of the A trigger, e.g. stored with the captures of an archive (see archive): the source, slope and
+    # level only for the edge trigger. The level is only known for analog channels (not for LINE, AUX or digital
+    # sources). Settings which cannot be queried are None, the query never fails.
+    def get_trigger_settings(self):
+        def value(command):
+            try:
+                return self._inst.query(command).strip().split(' ')[-1].upper()
+            except visa.errors.VisaIOError:  # not supported by the firmware or for the source
+                self._inst.clear()
+                self.clear_SESR_EventQueue_StatusByteReg()  # the command error would fail check_transfer_errors()
+                return None
+        settings = {"type": value('TRIGger:A:TYPe?'), "mode": value('TRIGger:A:MODe?')}
+        if settings["type"] == 'EDGE':
+            settings["source"] = value('TRIGger:A:EDGE:SOUrce?')
+            settings["slope"] = value('TRIGger:A:EDGE:SLOpe?')
+            level = None
+            if settings["source"] is not None and re.fullmatch(r'CH\d+', settings["source"]):
+                level = value('TRIGger:A:LEVel:{0}?'.format(settings["source"]))
+            settings["level"] = None if level is None else float(level)
+        return settings
+
     def get_available_channels(self):
         channels = self._inst.query('DATa:SOUrce:AVAILable?').strip().split(' ')[-1].split(',')
         # if 'none' not in map(str.lower, channels):
         #     channels = list(map(int, channels))
+        self.__available_channels = channels
         return channels
 
+    # type of a source name as listed by get_available_channels(), e.g. CH1 -> ANALOG, CH4_DALL or CH4_D3 -> DIGITAL
+    @staticmethod
+    def get_wave_type(channel):
+        name = channel.upper()
+        if re.search(r'_D(ALL|\d+)$', name):
+            return WaveType.DIGITAL
+        if name.startswith('MATH'):
+            return WaveType.MATH
+        return WaveType.ANALOG
+
     def set_transfer_source(self, channel):
         channel_str = channel
-        if channel_str in self._inst.query('DATa:SOUrce:AVAILable?').strip().split(' ')[-1].split(','):
-            return self._inst.write('DATa:SOUrce ' + channel_str)
+        # the list of available channels is only queried again if the channel is not known to be available
+        if self.__available_channels is None or channel_str not in self.__available_channels:
+            self.get_available_channels()
+        if channel_str in self.__available_channels:
+            return self._write_cached('DATa:SOUrce', channel_str)
         else:
             raise ValueError('Invalid channel selected')
 
     def set_transfer_encoding(self, encoding='ASCII'):
-        return self._inst.write('DATa:ENCdg ' + encoding)
+        return self._write_cached('DATa:ENCdg', encoding)
 
     def set_transfer_n_byte(self, num_of_bytes=1):
-        return self._inst.write('WFMOutpre:BYT_Nr ' + str(num_of_bytes))
+        return self._write_cached('WFMOutpre:BYT_Nr', num_of_bytes)
+
+    # Returns the encoding (default: self.encoding) to use for the next transfer with AUTO resolved by the ADC
+    # resolution and the acquisition mode. Transfers into integer buffers (integer=True) use 2 byte integers instead
+    # of floats.
+    def resolve_encoding(self, encoding=None, integer=False):
+        encoding = Encoding(self.encoding if encoding is None else encoding)
+        if encoding is Encoding.AUTO:
+            encoding = Encoding.INT16
+            if self.get_adc_bits() <= 8:  # e.g. the 12 bit MSO5 series always needs 2 bytes
+                mode = self._inst.query('ACQuire:MODe?').strip().split(' ')[-1].upper()
+                if mode.startswith(self.ONE_BYTE_ACQUISITION_MODES):
+                    encoding = Encoding.INT8
+        if integer and encoding is Encoding.FLOAT:
+            encoding = Encoding.INT16
+        return encoding
+
+    # bits of the ADC, looked up once per connection by the model in the *IDN? response
+    def get_adc_bits(self):
+        if self.__adc_bits is None:
+            model = self._inst.query('*IDN?').split(',')[1].strip().upper()
+            self.__adc_bits = next((bits for prefix, bits in self.ADC_BITS_BY_MODEL if model.startswith(prefix)), 16)
+        return self.__adc_bits
+
+    def _record_transfer(self, encoding, n_samples, n_bytes, duration):
+        self.last_transfer = {"encoding": encoding.value, "samples": n_samples, "bytes": n_bytes, "time": duration,
+                              "bytes_per_s": n_bytes / duration if duration > 0 else 0.0,
+                              "samples_per_s": n_samples / duration if duration > 0 else 0.0}
+
+    def set_transfer_resolution(self, resolution='FULL'):
+        return self._write_cached('DATa:RESOlution', resolution)
 
     def set_transfer_start_sample(self, start_sample=1):
-        return self._inst.write('DATa:STARt ' + str(start_sample))
+        return self._write_cached('DATa:STARt', start_sample)
 
     def set_transfer_end_sample(self, stop_sample=62500000):
-        return self._inst.write('DATa:STOP ' + str(stop_sample))
-
-    # Fetches the waveform from the instrument and converts it into volts
-    def transfer_waveform(self, channel):
+        return self._write_cached('DATa:STOP', stop_sample)
+
+    # Reads back the whole preamble of the waveform selected for transfer (see also setup_waveform_transfer)
+    # with a single query
+    def get_waveform_preamble(self):
+        return self.parse_preamble(self._inst.query('WFMOutpre?'))
+
+    @classmethod
+    def parse_preamble(cls, response):
+        # split at the semicolons outside of quoted strings (the waveform id contains commas and blanks)
+        fields = re.findall(r'(?:"[^"]*"|[^;])+', response.strip())
+        if fields and fields[0].startswith(':'):  # HEADer ON: every field is preceded by its header
+            fields = [field.split(' ', 1)[-1] for field in fields]
+        preamble = {}
+        for name, field in zip(cls.PREAMBLE_FIELDS, fields):
+            field = field.strip()
+            if name in ('byt_nr', 'bit_nr', 'nr_pt', 'pt_off'):
+                preamble[name] = int(float(field))
+            elif name in ('x_incr', 'x_zero', 'y_mult', 'y_off', 'y_zero', 'centerfrequency', 'span', 'reflevel'):
+                preamble[name] = float(field)
+            else:
+                preamble[name] = field.strip('"')
+        return preamble
+
+    # Opens a chunked transfer of the waveform. Iterating the returned stream walks the record in windows of
+    # chunk_size samples (DATa:STARt/DATa:STOP), so only one chunk has to be held in memory at a time. The raw
+    # codes are always integers (1 or 2 bytes, see resolve_encoding()).
+    def open_waveform_stream(self, channel, chunk_size=None, start_sample=1, end_sample=None, progress=None,
+                             encoding=None):
+        if chunk_size is None:
+            chunk_size = self.DEFAULT_CHUNK_SIZE
+        if end_sample is None:
+            end_sample = self.get_record_length()  # if no length is given, read in whole record length
+        encoding = self.resolve_encoding(encoding, integer=True)
+        scpi_encoding, n_byte, _, _ = self.ENCODING_FORMATS[encoding]
         self.setup_waveform_transfer(channel,
-                                     encoding='SRIbinary',  # SRIbinary -> little endian
-                                     # encoding='SFPbinary',  # SRIbinary -> little endian
-                                     n_byte=2,  # SRIbinary is either 1 or 2
-                                     # n_byte=4,  # number of bytes (float has 4)
+                                     encoding=scpi_encoding,
+                                     n_byte=n_byte,
+                                     start_sample=start_sample,
+                                     end_sample=end_sample,
                                      )
+        preamble = self.get_waveform_preamble()
+        return WaveformStream(self, preamble, start_sample, end_sample, chunk_size, progress, encoding)
+
+    # Fetches the waveform chunk by chunk into out (e.g. a preallocated numpy array or np.memmap with int8 or int16
+    # dtype) and returns a Waveform whose raw codes are a view of out. The data blocks are received straight into
+    # out, so the transfer width follows its type (encoding, if given, has to match it). The record length query
+    # can be saved by passing it.
+    def transfer_waveform_into(self, channel, out, chunk_size=None, start_sample=1, progress=None, record_length=None,
+                               encoding=None):
+        if encoding is None:
+            encoding = self.encoding_for(out.dtype)
+        end_sample = start_sample + len(out) - 1
+        if record_length is None:
+            record_length = self.get_record_length()
+        if end_sample > record_length:
+            end_sample = record_length
+        stream = self.open_waveform_stream(channel, chunk_size, start_sample, end_sample, progress, encoding)
+        if stream.dtype != out.dtype:
+            raise ValueError('Buffer type {0} does not fit the {1} encoding.'.format(out.dtype, stream.encoding.value))
+        stream.read_into(out)
+        return Waveform.from_preamble(out[:stream.n_samples], stream.preamble, channel=channel, timestamp=time())
+
+    # Fetches the waveform chunk by chunk into a memory-mapped capture file (see capture_file)
+    def transfer_waveform_to_file(self, channel, filename, chunk_size=None, progress=None, encoding=None):
+        stream = self.open_waveform_stream(channel, chunk_size, progress=progress, encoding=encoding)
+        timestamp = time()
+        out = capture_file.create(filename, stream.n_samples, stream.preamble, channel=channel, timestamp=timestamp,
+                                  dtype=stream.dtype)
+        stream.read_into(out)  # straight into the mapped file
+        out.flush()
+        return Waveform.from_preamble(out, stream.preamble, channel=channel, timestamp=timestamp)
+
+    # Fetches the waveform from the instrument. The raw codes are kept, volts and time are computed by the
+    # returned Waveform on demand. encoding overrides the encoding policy (self.encoding) for this transfer. With a
+    # pool (see buffer_pool.BufferPool) the data is received into a pooled buffer, which is handed back with
+    # pool.release(waveform.raw) when the waveform is not needed anymore. start_sample/end_sample (1 based,
+    # inclusive) limit the transfer to a part of the record, e.g. the visible range of a zoomed view (see regions).
+    def transfer_waveform(self, channel, encoding=None, pool=None, start_sample=1, end_sample=None):
+        if self.get_wave_type(channel) is WaveType.DIGITAL:
+            return self.transfer_digital(channel, pool, start_sample, end_sample)
+        encoding = self.resolve_encoding(encoding)
+        scpi_encoding, n_byte, _, dtype = self.ENCODING_FORMATS[encoding]
+        self.setup_waveform_transfer(channel, encoding=scpi_encoding, n_byte=n_byte, start_sample=start_sample,
+                                     end_sample=end_sample)
         self.clear_SESR_EventQueue_StatusByteReg()  # clear SESR
+        preamble = self.get_waveform_preamble()
         print('Start transferring data from instrument...', end='')
-        raw_data = self._inst.query_binary_values('CURVe?',  # transfer data command
-                                                  # datatype='f',  # float (4 bytes)
-                                                  datatype='h',  # signed short (2 bytes signed integer)
-                                                  is_big_endian=False,  # SRIbinary -> little endian
-                                                  container=np.array,  # return as numpy array
-                                                  data_points=self.get_record_length(),
-                                                  )
+        t_start = perf_counter()
+        self._inst.write('CURVe?')  # transfer data command
+        raw_data = self._read_binary_block(dtype, self._buffer(pool, preamble["nr_pt"], dtype))
+        self._record_transfer(encoding, raw_data.size, raw_data.nbytes, perf_counter() - t_start)
         print(' finished.')
+        timestamp = time()
+
+        self.check_transfer_errors()
+
+        return Waveform.from_preamble(raw_data, preamble, channel=channel, timestamp=timestamp)
+
+    # Fetches several channels of the same acquisition. The transfer settings are set up once, the preambles are
+    # read one after the other and the data is fetched with a single multi-source CURVe? query where the firmware
+    # supports it. The returned waveforms share the time base and are in the order of channels.
+    def transfer_waveforms(self, channels, encoding=None, pool=None):
+        channels = list(channels)
+        if len(channels) == 1:
+            return [self.transfer_waveform(channels[0], encoding, pool)]
+        digital = [channel for channel in channels if self.get_wave_type(channel) is WaveType.DIGITAL]
+        if digital:  # digital sources have their own encoding, the analog ones are still fetched together
+            analog = [channel for channel in channels if channel not in digital]
+            waveforms = dict(zip(analog, self.transfer_waveforms(analog, encoding, pool) if analog else []))
+            waveforms.update((channel, self.transfer_digital(channel, pool)) for channel in digital)
+            return [waveforms[channel] for channel in channels]
+        encoding = self.resolve_encoding(encoding)
+        scpi_encoding, n_byte, _, dtype = self.ENCODING_FORMATS[encoding]
+        record_length = self.get_record_length()
+        self.set_transfer_encoding(scpi_encoding)
+        self.set_transfer_n_byte(n_byte)
+        self.set_transfer_start_sample(1)
+        self.set_transfer_end_sample(record_length)
+        multi_source = self.supports_multi_source_curve()
+        self.clear_SESR_EventQueue_StatusByteReg()  # clear SESR
+        preambles = []
+        raw_data = []
+        print('Start transferring data from instrument...', end='')
+        duration = 0.0
+        for channel in channels:
+            self.set_transfer_source(channel)
+            preambles.append(self.get_waveform_preamble())
+            if not multi_source:
+                t_start = perf_counter()
+                self._inst.write('CURVe?')
+                raw_data.append(self._read_binary_block(dtype, self._buffer(pool, preambles[-1]["nr_pt"], dtype)))
+                duration += perf_counter() - t_start
+        if multi_source:
+            self._write_cached('DATa:SOUrce', ','.join(channels))
+            t_start = perf_counter()
+            self._inst.write('CURVe?')
+            raw_data = [self._read_binary_block(dtype, self._buffer(pool, preamble["nr_pt"], dtype))
+                        for preamble in preambles]
+            duration = perf_counter() - t_start
+        self._record_transfer(encoding, sum(raw.size for raw in raw_data), sum(raw.nbytes for raw in raw_data),
+                              duration)
+        print(' finished.')
+        timestamp = time()
+
+        self.check_transfer_errors()
+
+        return [Waveform.from_preamble(raw, preamble, channel=channel, timestamp=timestamp)
+                for raw, preamble, channel in zip(raw_data, preambles, channels)]
+
+    # preamble of the whole record of the channel for transfers with the given encoding (nothing is transferred)
+    def get_transfer_preamble(self, channel, encoding=None):
+        scpi_encoding, n_byte, _, _ = self.ENCODING_FORMATS[self.resolve_encoding(encoding)]
+        self.setup_waveform_transfer(channel, encoding=scpi_encoding, n_byte=n_byte)
+        return self.get_waveform_preamble()
+
+    # Fetches a coarse overview of the whole record with DATa:RESOlution REDUced, i.e. a record reduced by the
+    # instrument to a few thousand samples, which is transferred in a fraction of the time of the full record. The
+    # time axis of the returned Waveform spans the whole record. Returns None if the firmware does not support
+    # reduced resolution transfers.
+    def transfer_overview(self, channel, encoding=None):
+        if not self.supports_reduced_resolution():
+            return None
+        encoding = self.resolve_encoding(encoding)
+        scpi_encoding, n_byte, _, dtype = self.ENCODING_FORMATS[encoding]
+        self.setup_waveform_transfer(channel, encoding=scpi_encoding, n_byte=n_byte)
+        self.set_transfer_resolution('REDUced')
+        try:
+            self.clear_SESR_EventQueue_StatusByteReg()  # clear SESR
+            preamble = self.get_waveform_preamble()
+            print('Start transferring overview from instrument...', end='')
+            t_start = perf_counter()
+            self._inst.write('CURVe?')  # transfer data command
+            raw_data = self._read_binary_block(dtype)
+            self._record_transfer(encoding, raw_data.size, raw_data.nbytes, perf_counter() - t_start)
+            print(' finished.')
+            self.check_transfer_errors()
+        finally:
+            self.set_transfer_resolution('FULL')  # all other transfers are at full resolution
+        return Waveform.from_preamble(raw_data, preamble, channel=channel, timestamp=time())
+
+    # detects once per connection if DATa:RESOlution is known to the firmware (no command error)
+    def supports_reduced_resolution(self):
+        if self.__reduced_resolution is None:
+            self.clear_SESR_EventQueue_StatusByteReg()
+            self._inst.write('DATa:RESOlution FULL')
+            self.__reduced_resolution = not int(self._inst.query('*ESR?')) & int('0b00100000', 2)
+        return self.__reduced_resolution
+
+    # Fetches a digital source (CHx_DALL: all lanes, CHx_Dn: one lane) and returns it bit-packed as
+    # digital.DigitalWaveform, i.e. with 1 bit per sample and lane. The received bytes are only needed while packing,
+    # with a pool they are received into a pooled buffer which is released right away. start_sample/end_sample limit
+    # the transfer as for transfer_waveform().
+    def transfer_digital(self, channel, pool=None, start_sample=1, end_sample=None):
+        scpi_encoding, n_byte, _, dtype = self.DIGITAL_FORMAT
+        self.setup_waveform_transfer(channel, encoding=scpi_encoding, n_byte=n_byte, start_sample=start_sample,
+                                     end_sample=end_sample)
+        self.clear_SESR_EventQueue_StatusByteReg()  # clear SESR
+        preamble = self.get_waveform_preamble()
+        print('Start transferring data from instrument...', end='')
+        t_start = perf_counter()
+        self._inst.write('CURVe?')  # transfer data command
+        buffer = self._buffer(pool, preamble["nr_pt"], dtype)
+        samples = self._read_binary_block(dtype, buffer)
+        self._record_transfer(Encoding.INT8, samples.size, samples.nbytes, perf_counter() - t_start)
+        print(' finished.')
+        timestamp = time()
 
-        y_mult = float(self._inst.query('WFMOutpre:YMUlt?').split(' ')[-1])
-        y_zero = float(self._inst.query('WFMOutpre:YZEro?').split(' ')[-1])
-        # y_off = float(self._inst.query('WFMOutpre:YZEro?').split(' ')[-1])
-        x_incr = float(self._inst.query('WFMOutpre:XINcr?').split(' ')[-1])
-        x_zero = float(self._inst.query('WFMOutpre:XZEro?').split(' ')[-1])
-        pre_trig_record = int(self._inst.query('WFMOutpre:PT_Off?').split(' ')[-1])
-
-        # scaled_data = ((raw_data - y_off) * y_mult) + y_zero
-        scaled_data = (raw_data * y_mult) + y_zero  # MSO54: y_off is always zero!
-        total_time = (len(raw_data)-1) * x_incr
-        t_start = (-1 * pre_trig_record * x_incr) + x_zero
-        t_stop = t_start + total_time
-        scaled_time = np.linspace(t_start, t_stop, len(raw_data))
+        self.check_transfer_errors()
 
+        prefix, _, lane = channel.upper().rpartition('_D')
+        if lane == 'ALL':
+            waveform = DigitalWaveform.from_samples(samples, preamble, channel=channel, timestamp=timestamp,
+                                                    lane_names=['{0}_D{1}'.format(prefix, n)
+                                                                for n in range(self.DIGITAL_LANES)])
+        else:
+            waveform = DigitalWaveform.from_samples(samples != 0, preamble, lanes=[0], lane_names=[channel],
+                                                    channel=channel, timestamp=timestamp)
+        if buffer is not None:
+            pool.release(buffer)
+        return waveform
+
+    # detects once per connection if DATa:SOUrce accepts a list of sources (and CURVe? returns all of them)
+    def supports_multi_source_curve(self):
+        if self.__multi_source_curve is None:
+            channels = self.get_available_channels()
+            if len(channels) < 2:
+                return False
+            self._write_cached('DATa:SOUrce', ','.join(channels[:2]))
+            self.__multi_source_curve = ',' in self._inst.query('DATa:SOUrce?')
+        return self.__multi_source_curve
+
+    # Reads one IEEE 488.2 definite length block (#<n><length><data>) and the following separator. The data is
+    # received straight into out if given (returns the filled part of it), otherwise into a new array.
+    def _read_binary_block(self, dtype, out=None):
+        dtype = np.dtype(dtype)
+        for _ in range(64):  # skips a response header (HEADer ON) or the separator of the previous block
+            if self._inst.read_bytes(1) == b'#':
+                break
+        else:
+            raise DataTransferError('No binary block received.')
+        n_digits = int(self._inst.read_bytes(1))
+        n_bytes = int(self._inst.read_bytes(n_digits))
+        n_samples = n_bytes // dtype.itemsize
+        if out is None:
+            out = np.empty(n_samples, dtype=dtype)
+        elif out.dtype != dtype or len(out) < n_samples:
+            self._inst.clear()  # discard the rest of the response
+            raise DataTransferError('Received {0} bytes, which do not fit into the buffer.'.format(n_bytes))
+        out = out[:n_samples]
+        # recorded as one call whatever the read path, a direct viRead would bypass the TracedResource otherwise
+        start = perf_counter()
+        try:
+            self._readinto(memoryview(out).cast('B'))
+        except Exception as error:
+            self._record_block_read(start, 0, error)
+            raise
+        self._record_block_read(start, n_bytes)
+        self._inst.read_bytes(1)  # ';' between the blocks or the termination character at the end
+        return out
+
+    # under a key of its own, so the CURVe? count and latencies are those of the queries sent
+    def _record_block_read(self, start, n_bytes, error=None):
+        if self.TRACE_IO:
+            self.io_statistics.record('CURVe? <block>', 'read_block', start, perf_counter() - start, n_bytes, error)
+
+    # Fills the writable byte memoryview with the next bytes of the response. Without intermediate copies, if the
+    # resource offers readinto() or the VISA library is a ctypes library with viRead (NI-VISA, Keysight, R&S),
+    # otherwise the data is read with read_bytes() in chunks and copied. The chunks are not traced, the caller
+    # records the whole block.
+    def _readinto(self, view):
+        resource = tracing.untraced(self._inst)
+        readinto = getattr(resource, 'readinto', None)
+        if readinto is None:
+            vi_read = getattr(getattr(getattr(resource, 'visalib', None), 'lib', None), 'viRead', None)
+            if vi_read is not None:
+                readinto = self._vi_readinto(vi_read)
+        offset = 0
+        while offset < len(view):
+            chunk = view[offset:offset + self.READ_CHUNK_SIZE]
+            if readinto is None:
+                data = resource.read_bytes(len(chunk))
+                chunk[:len(data)] = data
+                n_bytes = len(data)
+            else:
+                n_bytes = readinto(chunk)
+            if n_bytes <= 0:
+                raise DataTransferError('Data block ended early.')
+            offset += n_bytes
+
+    def _vi_readinto(self, vi_read):
+        session = tracing.untraced(self._inst).session
+
+        def readinto(chunk):
+            count = ctypes.c_uint32()
+            status = vi_read(session, (ctypes.c_ubyte * len(chunk)).from_buffer(chunk), len(chunk), ctypes.byref(count))
+            if status < 0:
+                raise visa.errors.VisaIOError(status)
+            return count.value
+        return readinto
+
+    @staticmethod
+    def _buffer(pool, n_samples, dtype):
+        return None if pool is None else pool.acquire(n_samples, dtype)
+
+    # transfer encoding of the raw codes with the given numpy type (1 or 2 byte integers)
+    def encoding_for(self, dtype):
+        for encoding in (Encoding.INT8, Encoding.INT16):
+            if np.dtype(self.ENCODING_FORMATS[encoding][3]) == dtype:
+                return encoding
+        raise ValueError('Buffer type {0} is not supported, use int8 or int16.'.format(dtype))
+
+    def check_transfer_errors(self):
         if (int(self._inst.query('*ESR?')) & int('0b00111100', 2)):  # check if any error occurred
             raise DataTransferError('Data transfer has been corrupted.')
 
-        return scaled_time, scaled_data, x_incr
-
     # Setup the waveform transfer as described in the programmer manual at page 2-90
     def setup_waveform_transfer(self, channel, encoding, n_byte, start_sample=1, end_sample=None):
         self.set_transfer_source(channel)
@@ -224,3 +775,127 @@ class MSO54:
         if end_sample is None:
             end_sample = self.get_record_length()  # if no length is given, read in whole record length
         self.set_transfer_end_sample(end_sample)
+
+    # FastFrame (segmented memory): every trigger event fills one frame of the current record length, so a burst of
+    # events is captured with a single arm. Switch FastFrame off again before normal transfers.
+    def set_fast_frame(self, n_frames=None):
+        if n_frames is None:
+            self._inst.write('HORizontal:FASTframe:STATE OFF')
+        else:
+            self._inst.write('HORizontal:FASTframe:COUNt ' + str(n_frames))
+            self._inst.write('HORizontal:FASTframe:STATE ON')
+
+    def get_fast_frame_count(self):
+        return int(self._inst.query('HORizontal:FASTframe:COUNt?').split(' ')[-1])
+
+    def set_transfer_frames(self, first_frame, last_frame):
+        self._write_cached('DATa:FRAMESTARt', first_frame)
+        self._write_cached('DATa:FRAMESTOP', last_frame)
+
+    # arms a FastFrame acquisition of n_frames frames and waits until all of them have been acquired
+    def acquire_fast_frames(self, n_frames, timeout=None):
+        self.set_fast_frame(n_frames)
+        self.acquire_single_sequence(wait_for_completion=True, timeout=timeout)
+
+    # Streams all frames of the last FastFrame acquisition to sink (see fastframe, e.g. a FrameRingBuffer or a
+    # FrameFileWriter). Setup and preamble are only done once, every CURVe? query returns frames_per_transfer
+    # frames. Returns the number of frames transferred.
+    def transfer_fast_frames(self, channel, sink, frames_per_transfer=None, encoding=None):
+        frame_length = self.get_record_length()
+        n_frames = self.get_fast_frame_count()
+        if frames_per_transfer is None:
+            frames_per_transfer = max(self.DEFAULT_CHUNK_SIZE // frame_length, 1)
+        encoding = self.resolve_encoding(encoding, integer=True)
+        scpi_encoding, n_byte, _, dtype = self.ENCODING_FORMATS[encoding]
+        self.setup_waveform_transfer(channel, encoding=scpi_encoding, n_byte=n_byte, start_sample=1,
+                                     end_sample=frame_length)
+        buffer = np.empty((min(frames_per_transfer, n_frames), frame_length), dtype=dtype)  # reused for all batches
+        self.clear_SESR_EventQueue_StatusByteReg()  # clear SESR
+        preamble = self.get_waveform_preamble()
+        try:
+            timestamps = fastframe.parse_timestamps(
+                self._inst.query('HORizontal:FASTframe:TIMEStamp:ALL:' + channel + '?'))
+        except visa.errors.VisaIOError:  # not supported by the firmware
+            self._inst.clear()
+            self.clear_SESR_EventQueue_StatusByteReg()  # the command error would fail check_transfer_errors()
+            timestamps = np.zeros(0, dtype=np.int64)
+        if len(timestamps) < n_frames:  # time stamps not available, frames are still transferred
+            timestamps = np.concatenate((timestamps, np.zeros(n_frames - len(timestamps), dtype=np.int64)))
+        sink.begin(preamble, frame_length, channel)
+        for first in range(1, n_frames + 1, frames_per_transfer):
+            last = min(first + frames_per_transfer - 1, n_frames)
+            self.set_transfer_frames(first, last)
+            self._inst.write('CURVe?')
+            frames = buffer[:last - first + 1]
+            self._read_binary_block(dtype, frames.reshape(-1))
+            sink.append(frames, timestamps[first - 1:last])
+        self.check_transfer_errors()
+        return n_frames
+
+
+class WaveformStream:
+    """Iterable chunked waveform transfer as returned by MSO54.open_waveform_stream()
+
+    Yields tuples (offset, raw_data) where offset is the index of the first sample of the chunk within the
+    transfer and raw_data holds the raw codes (int8 or int16, see dtype). The optional progress callback is called
+    with (transferred_samples, total_samples) after every chunk.
+    """
+
+    def __init__(self, instrument, preamble, start_sample, end_sample, chunk_size, progress=None,
+                 encoding=Encoding.INT16):
+        self.instrument = instrument
+        self.preamble = preamble
+        self.start_sample = start_sample
+        self.end_sample = end_sample
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.encoding = encoding
+        _, _, self.datatype, dtype = instrument.ENCODING_FORMATS[encoding]
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def n_samples(self):
+        return self.end_sample - self.start_sample + 1
+
+    def __len__(self):
+        return self.n_samples
+
+    def __iter__(self):
+        inst = self.instrument
+        inst.clear_SESR_EventQueue_StatusByteReg()  # clear SESR
+        duration = 0.0
+        for first in range(self.start_sample, self.end_sample + 1, self.chunk_size):
+            last = min(first + self.chunk_size - 1, self.end_sample)
+            inst.set_transfer_start_sample(first)
+            inst.set_transfer_end_sample(last)
+            t_start = perf_counter()
+            raw_data = inst._inst.query_binary_values('CURVe?',
+                                                      datatype=self.datatype,  # b or h (signed integers)
+                                                      is_big_endian=False,  # SRIbinary -> little endian
+                                                      container=np.array,  # return as numpy array
+                                                      data_points=last - first + 1,
+                                                      )
+            duration += perf_counter() - t_start
+            if self.progress is not None:
+                self.progress(last - self.start_sample + 1, self.n_samples)
+            yield first - self.start_sample, raw_data
+        inst._record_transfer(self.encoding, self.n_samples, self.n_samples * self.dtype.itemsize, duration)
+        inst.check_transfer_errors()
+
+    # receives all chunks straight into out (numpy array or memmap of dtype with at least n_samples elements)
+    def read_into(self, out):
+        inst = self.instrument
+        inst.clear_SESR_EventQueue_StatusByteReg()  # clear SESR
+        duration = 0.0
+        for first in range(self.start_sample, self.end_sample + 1, self.chunk_size):
+            last = min(first + self.chunk_size - 1, self.end_sample)
+            inst.set_transfer_start_sample(first)
+            inst.set_transfer_end_sample(last)
+            t_start = perf_counter()
+            inst._inst.write('CURVe?')
+            inst._read_binary_block(self.dtype, out[first - self.start_sample:last - self.start_sample + 1])
+            duration += perf_counter() - t_start
+            if self.progress is not None:
+                self.progress(last - self.start_sample + 1, self.n_samples)
+        inst._record_transfer(self.encoding, self.n_samples, self.n_samples * self.dtype.itemsize, duration)
+        inst.check_transfer_errors()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+""" Headless batch capture from the MSO54 without any GUI imports (for scripted test stations).
+
+Connects to the instrument, arms a single sequence per acquisition, waits for the trigger and writes the chosen
+channels of every acquisition to files in the output directory. Run e.g.
+
+    python mso_cli.py --channels CH1 CH2 --count 10 --output-dir captures --format msocap
+
+File names are <prefix>_<acquisition>_<channel>.<format> (csv: one file per acquisition with a column per channel,
+msoarc: all acquisitions are appended to <prefix>.msoarc together with the trigger settings, see archive). Digital
+sources (e.g. CH4_DALL) are written bit-packed to npz or as list of edges to <prefix>_<acquisition>_<channel>.csv
+(see digital).
+With several --address values all instruments are captured together (see session) and the files are named
+<prefix>_<acquisition>_scope<n>_<channel>.<format> with n the position of the address.
+The exit code is 0 on success and 1 if an instrument could not be reached or an acquisition failed.
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+from time import perf_counter
+import pyvisa as visa
+
+import archive
+import capture_file
+from digital import DigitalWaveform
+import export
+import mso54
+from session import Session
+
+FORMATS = ('npz', 'msocap', 'csv', 'msoarc')
+
+
+def _file_name(args, index, channel=None, scope=None):
+    name = '{0}_{1:04d}'.format(args.prefix, index)
+    for part in (scope, channel):
+        if part is not None:
+            name += '_' + part
+    return os.path.join(args.output_dir, name + '.' + args.format)
+
+
+def write_waveforms(args, index, waveforms, scope=None, trigger=None):
+    if args.format == 'csv':
+        analog = [waveform for waveform in waveforms if not isinstance(waveform, DigitalWaveform)]
+        names = [_file_name(args, index, scope=scope)] if analog else []
+        if analog:
+            export.write_csv(names[0], analog)
+        for waveform in waveforms:
+            if isinstance(waveform, DigitalWaveform):
+                names.append(_file_name(args, index, waveform.channel, scope))
+                export.write_edges_csv(names[-1], waveform)
+        return names
+    if args.format == 'msoarc':
+        names = [os.path.join(args.output_dir, args.prefix + archive.EXTENSION)]
+        with archive.ArchiveWriter(names[0]) as writer:
+            for waveform in waveforms:
+                writer.append(waveform, info={"acquisition": index, "scope": scope, "trigger": trigger})
+        return names
+    names = []
+    for waveform in waveforms:
+        name = _file_name(args, index, waveform.channel, scope)
+        if args.format == 'npz':
+            with open(name, 'wb') as f:
+                waveform.save_npz(f)
+        else:
+            capture_file.write(name, waveform)
+        names.append(name)
+    return names
+
+
+def capture(instrument, args):
+    for index in range(args.count):
+        t_start = perf_counter()
+        if not args.no_arm:
+            instrument.acquire_single_sequence(wait_for_completion=True, timeout=args.timeout)
+        waveforms = instrument.transfer_waveforms(args.channels, encoding=args.encoding)
+        trigger = instrument.get_trigger_settings() if args.format == 'msoarc' else None
+        names = write_waveforms(args, index, waveforms, trigger=trigger)
+        if not args.quiet:
+            print('{0}/{1}: {2} ({3:.0f} ms)'.format(index + 1, args.count, ', '.join(names),
+                                                     1e3 * (perf_counter() - t_start)), file=sys.stderr)
+
+
+# captures all instruments of the session together, returns the number of failed captures
+def capture_session(session, args):
+    failures = 0
+    for index in range(args.count):
+        t_start = perf_counter()
+        results = session.capture(args.channels, timeout=args.timeout, arm=not args.no_arm, encoding=args.encoding,
+                                  trigger=args.format == 'msoarc')
+        names = []
+        for scope, address in enumerate(session.addresses):
+            result = results[address]
+            if result["error"] is None:
+                names += write_waveforms(args, index, result["waveforms"], 'scope{0}'.format(scope), result["trigger"])
+            else:
+                failures += 1
+                print('{0}: {1}'.format(address, result["error"]), file=sys.stderr)
+        if not args.quiet:
+            print('{0}/{1}: {2} ({3:.0f} ms)'.format(index + 1, args.count, ', '.join(names),
+                                                     1e3 * (perf_counter() - t_start)), file=sys.stderr)
+        session.connect()  # instruments which failed are tried again for the next acquisition
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--address', nargs='+', default=[],
+                        help='VISA address, several ones are captured together (default: search the USB instruments)')
+    parser.add_argument('--channels', nargs='+', default=['CH1'], help='sources, e.g. CH1 CH2 MATH1 CH4_DALL')
+    parser.add_argument('-n', '--count', type=int, default=1, help='number of acquisitions')
+    parser.add_argument('-o', '--output-dir', default='.', help='directory of the written files')
+    parser.add_argument('--prefix', default='capture', help='file name prefix')
+    parser.add_argument('--format', default='npz', choices=FORMATS)
+    parser.add_argument('--timeout', type=float, default=mso54.MSO54.DEFAULT_ACQUISITION_TIMEOUT,
+                        help='maximum time to wait for a trigger in s')
+    parser.add_argument('--encoding', default=mso54.MSO54.DEFAULT_ENCODING.value,
+                        choices=[encoding.value for encoding in mso54.Encoding])
+    parser.add_argument('--no-arm', action='store_true', help='transfer the current acquisition only (no arming)')
+    parser.add_argument('--simulate', action='store_true', help='use the simulated instrument (see sim_mso)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='no progress output (also not of the driver)')
+    args = parser.parse_args(argv)
+    if args.no_arm:
+        args.count = 1
+    if args.format in ('msocap', 'msoarc') and any(mso54.MSO54.get_wave_type(channel) is mso54.WaveType.DIGITAL
+                                                   for channel in args.channels):
+        parser.error('digital sources can be written to npz or csv only')
+    if args.quiet:
+        # the driver reports every transfer on stdout
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return run(args)
+    return run(args)
+
+
+# connects to the instruments and captures, returns the exit code
+def run(args):
+    resource_manager = None
+    if args.simulate:
+        import sim_mso
+        args.address = args.address or [sim_mso.ADDRESS]
+        digital = [channel for channel in args.channels
+                   if mso54.MSO54.get_wave_type(channel) is mso54.WaveType.DIGITAL]
+        resource_manager = sim_mso.SimulatedResourceManager({address: sim_mso.SimulatedMSO(address, digital=digital)
+                                                              for address in args.address})
+    os.makedirs(args.output_dir, exist_ok=True)
+    if len(args.address) > 1:
+        with Session(args.address, resource_manager=resource_manager) as session:
+            for address, error in session.connect().items():
+                if error is not None:
+                    print('{0}: {1}'.format(address, error), file=sys.stderr)
+            return 1 if capture_session(session, args) else 0
+
+    instrument = mso54.MSO54(args.address[0] if args.address else None, resource_manager=resource_manager)
+    try:
+        instrument.connect()
+    except (mso54.NoConnectionError, mso54.WrongInstrumentError) as error:
+        print(error, file=sys.stderr)
+        return 1
+    try:
+        capture(instrument, args)
+    except (mso54.AcquisitionTimeoutError, mso54.DataTransferError, visa.errors.Error, ValueError) as error:
+        print(error, file=sys.stderr)
+        return 1
+    finally:
+        instrument.disconnect()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
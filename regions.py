@@ -0,0 +1,132 @@
+""" Region-on-demand access to long records in the instrument memory for zoomed views.
+
+Instead of transferring a whole record before anything can be shown, an interactive view fetches a coarse overview
+first (see MSO54.transfer_overview()) and then only the visible sample range at full resolution with
+DATa:STARt/DATa:STOP. The fetched samples are kept in a RegionCache: the record is split into blocks of block_size
+samples, missing blocks are fetched in contiguous runs (one CURVe? per run) and the least recently used blocks are
+evicted once the cache holds more than max_bytes. Zooming back into a range seen before costs no I/O at all.
+
+The cached blocks belong to the acquisition in the instrument memory, so the instrument should be stopped (e.g. a
+single sequence) while the record is explored, and the cache has to be cleared when a new acquisition is read.
+"""
+
+from collections import OrderedDict
+import numpy as np
+
+from waveform import Waveform
+
+DEFAULT_BLOCK_SIZE = 262144  # samples
+DEFAULT_MAX_BYTES = 268435456  # 256 MB
+MAX_REGION_SAMPLES = 4194304  # wider ranges are shown from the overview
+
+
+class RegionCache:
+    """LRU cache of fixed size blocks of raw codes keyed by source and block number
+
+    Not thread-safe, it is used by the worker thread of the model only.
+    """
+
+    # constructor
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, max_bytes=DEFAULT_MAX_BYTES):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0  # blocks served from the cache
+        self.misses = 0  # blocks fetched
+        self.__blocks = OrderedDict()  # (source, block number) -> raw codes, least recently used first
+
+    def __len__(self):
+        return len(self.__blocks)
+
+    def __contains__(self, key):
+        return key in self.__blocks
+
+    def clear(self):
+        self.__blocks = OrderedDict()
+        self.nbytes = 0
+
+    # Returns the raw codes of the samples start to stop - 1 of the source. The missing blocks are fetched with
+    # fetch(first, last), which returns the codes of the samples first to last - 1 (fewer at the end of the record).
+    def get(self, source, start, stop, fetch):
+        size = self.block_size
+        blocks = range(start // size, (stop - 1) // size + 1 if stop > start else start // size)
+        missing = [block for block in blocks if (source, block) not in self.__blocks]
+        for run in np.split(np.asarray(missing, dtype=np.int64), np.flatnonzero(np.diff(missing) != 1) + 1):
+            if len(run) == 0:
+                continue
+            data = fetch(int(run[0]) * size, (int(run[-1]) + 1) * size)
+            for i, block in enumerate(run):
+                # copied, so every block can be evicted on its own
+                self.__put((source, int(block)), data[i * size:(i + 1) * size].copy())
+        self.hits += len(blocks) - len(missing)
+        self.misses += len(missing)
+        out = None
+        for block in blocks:
+            codes = self.__blocks[(source, block)]
+            self.__blocks.move_to_end((source, block))
+            if out is None:
+                out = np.empty(stop - start, dtype=codes.dtype)
+            begin = block * size
+            lo, hi = max(start, begin), min(stop, begin + len(codes))
+            out[lo - start:hi - start] = codes[lo - begin:hi - begin]
+        self.__evict()
+        return out if out is not None else np.empty(0)
+
+    def __put(self, key, codes):
+        if key in self.__blocks:
+            self.nbytes -= self.__blocks[key].nbytes
+        self.__blocks[key] = codes
+        self.nbytes += codes.nbytes
+
+    def __evict(self):
+        while self.nbytes > self.max_bytes and self.__blocks:
+            _, codes = self.__blocks.popitem(last=False)
+            self.nbytes -= codes.nbytes
+
+
+class RecordRegions:
+    """Full resolution access to the record of one channel in the instrument memory, backed by a RegionCache"""
+
+    # constructor
+    # encoding is used for all regions (e.g. the one of the overview), so the blocks share their scale factors
+    def __init__(self, instrument, channel, encoding, cache, timestamp=None):
+        self.instrument = instrument
+        self.channel = channel
+        self.encoding = encoding
+        self.cache = cache
+        self.timestamp = timestamp
+        self.preamble = instrument.get_transfer_preamble(channel, encoding)  # of the whole record
+        self.n_samples = self.preamble["nr_pt"]
+
+    @property
+    def t_start(self):
+        return (-1 * self.preamble["pt_off"] * self.preamble["x_incr"]) + self.preamble["x_zero"]
+
+    @property
+    def t_stop(self):
+        return self.t_start + (self.n_samples - 1) * self.preamble["x_incr"]
+
+    # sample range (start, stop) covering the time range, including the samples just outside of it
+    def index_range(self, t_start, t_stop):
+        x_incr = self.preamble["x_incr"]
+        start = int(np.floor((t_start - self.t_start) / x_incr))
+        stop = int(np.ceil((t_stop - self.t_start) / x_incr)) + 1
+        return max(start, 0), min(stop, self.n_samples)
+
+    # waveform of the samples start to stop - 1 at full resolution
+    def read(self, start, stop):
+        raw = self.cache.get(self.channel, start, stop, self.__fetch)
+        waveform = Waveform.from_preamble(raw, self.preamble, channel=self.channel, timestamp=self.timestamp)
+        waveform.x_zero += start * waveform.x_incr
+        return waveform
+
+    # max_samples samples around the trigger (t = 0)
+    def read_around_trigger(self, max_samples=MAX_REGION_SAMPLES):
+        trigger = int(np.rint(-self.t_start / self.preamble["x_incr"]))
+        start = min(max(trigger - max_samples // 2, 0), max(self.n_samples - max_samples, 0))
+        return self.read(start, min(start + max_samples, self.n_samples))
+
+    def __fetch(self, first, last):
+        last = min(last, self.n_samples)
+        return self.instrument.transfer_waveform(self.channel, self.encoding, start_sample=first + 1,
+                                                 end_sample=last).raw
@@ -1,8 +1,6 @@
 # run.pyw
 #
 # to do:
-# - implement a separate thread for the timer function as otherwise using the toolbar on the matplotlib drawing
-#   exhibits some delay
 # - there is still the error from pyvisa when exit the program with an active connection. Until now there seems to
 #   be no solution. Trying to close the visa resource within the destructor methods failed.
 #
@@ -18,7 +16,17 @@
 #   File "...\lib\site-packages\pyvisa\ctwrapper\highlevel.py", line 188, in _return_handler
 # pyvisa.errors.VisaIOError: VI_ERROR_INV_OBJECT (-1073807346): The given session or object reference is invalid.
 
-from control import Control
-from model import Model
-app = Control(Model())
-app.run()
+#
+# Without arguments the GUI is started. With arguments (e.g. "run.pyw --channels CH1 CH2 --count 10") the headless
+# batch capture of mso_cli runs instead, the GUI modules (tkinter, matplotlib) are then not even imported.
+
+import sys
+
+if len(sys.argv) > 1:
+    from mso_cli import main
+    raise SystemExit(main(sys.argv[1:]))
+else:
+    from control import Control
+    from model import Model
+    app = Control(Model())
+    app.run()
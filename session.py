@@ -0,0 +1,118 @@
+""" Synchronized captures from several MSO54 instruments (e.g. all scopes of a test cell).
+
+A Session owns one MSO54 connection per VISA address and drives them concurrently from a thread pool: all
+instruments are armed first, then every instrument waits for its trigger and transfers its channels on its own
+thread. The capture time of N instruments is therefore close to the one of the slowest instrument.
+
+Every capture returns one result dict per address:
+    "waveforms": list of waveform.Waveform (None if the capture failed)
+    "error": the exception raised by this instrument (None on success), the other instruments are not affected
+    "timestamp": time() when the acquisition was found complete, also set as timestamp of the waveforms
+    "offset": timestamp relative to the earliest successful instrument in s (host clock, for alignment)
+    "arm_time", "acquisition_time", "transfer_time": duration of the phases in s
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from time import time
+import pyvisa as visa
+
+import mso54 as analyzer
+
+
+class Session:
+    """Pool of MSO54 connections which are armed and read concurrently"""
+
+    # constructor
+    # resource_manager is passed to every MSO54, e.g. a sim_mso.SimulatedResourceManager
+    def __init__(self, addresses, resource_manager=None, max_workers=None):
+        self.addresses = list(addresses)
+        self.instruments = {address: analyzer.MSO54(address, resource_manager=resource_manager)
+                            for address in self.addresses}
+        self.connected = set()
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers or max(len(self.addresses), 1),
+                                             thread_name_prefix='session')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # runs func(instrument) for the given addresses concurrently, returns address -> (result, error)
+    def _run(self, func, addresses):
+        futures = {address: self.__executor.submit(func, self.instruments[address]) for address in addresses}
+        outcome = {}
+        for address, future in futures.items():
+            try:
+                outcome[address] = (future.result(), None)
+            except Exception as error:  # isolate the failure to this instrument
+                outcome[address] = (None, error)
+        return outcome
+
+    # connects all instruments which are not connected yet, returns address -> error (None if connected)
+    def connect(self):
+        outcome = self._run(lambda instrument: instrument.connect(),
+                            [address for address in self.addresses if address not in self.connected])
+        for address, (_, error) in outcome.items():
+            if error is None:
+                self.connected.add(address)
+        return {address: error for address, (_, error) in outcome.items()}
+
+    def disconnect(self):
+        self._run(lambda instrument: instrument.disconnect(), self.connected)
+        self.connected = set()
+
+    def close(self):
+        self.disconnect()
+        self.__executor.shutdown()
+
+    # Arms all connected instruments (arm=True), waits for their acquisitions and transfers channels from every
+    # one of them, with trigger=True also their trigger settings (see MSO54.get_trigger_settings()). Instruments with
+    # I/O errors are disconnected and reconnected with the next connect().
+    def capture(self, channels, timeout=None, arm=True, encoding=None, pool=None, trigger=False):
+        results = {address: {"waveforms": None, "error": analyzer.NoConnectionError('Not connected.'),
+                             "timestamp": None, "offset": None, "arm_time": 0.0, "acquisition_time": 0.0,
+                             "transfer_time": 0.0, "trigger": None}
+                   for address in self.addresses}
+        addresses = [address for address in self.addresses if address in self.connected]
+        if arm:
+            armed = self._run(lambda instrument: self.__timed(instrument.arm_single_sequence), addresses)
+            for address, (duration, error) in armed.items():
+                results[address].update(arm_time=duration or 0.0, error=error)
+            addresses = [address for address in addresses if armed[address][1] is None]
+
+        def wait_and_transfer(instrument):
+            t_start = perf_counter()
+            if arm:
+                instrument.wait_for_acquisition(timeout)
+            timestamp = time()
+            t_complete = perf_counter()
+            waveforms = instrument.transfer_waveforms(channels, encoding=encoding, pool=pool)
+            for waveform in waveforms:
+                waveform.timestamp = timestamp
+            transfer_time = perf_counter() - t_complete
+            return {"waveforms": waveforms, "timestamp": timestamp, "acquisition_time": t_complete - t_start,
+                    "transfer_time": transfer_time, "trigger": instrument.get_trigger_settings() if trigger else None}
+
+        for address, (result, error) in self._run(wait_and_transfer, addresses).items():
+            results[address].update(result or {}, error=error)
+        for address, result in results.items():
+            if isinstance(result["error"], visa.errors.Error) and address in self.connected:
+                self.instruments[address].disconnect()
+                self.connected.discard(address)
+        self.align(results)
+        return results
+
+    @staticmethod
+    def align(results):
+        timestamps = [result["timestamp"] for result in results.values() if result["timestamp"] is not None]
+        for result in results.values():
+            if result["timestamp"] is not None:
+                result["offset"] = result["timestamp"] - min(timestamps)
+
+    @staticmethod
+    def __timed(func):
+        t_start = perf_counter()
+        func()
+        return perf_counter() - t_start
@@ -0,0 +1,308 @@
+""" Simulated Tektronix MSO for testing and benchmarking without an instrument.
+
+SimulatedMSO speaks the subset of SCPI used by mso54.MSO54 and mimics the pyvisa resource interface. Every command
+costs a configurable latency and binary data is delivered with a configurable link bandwidth, so transfer times are
+comparable to a real USBTMC or LAN connection. The counters (writes, queries, bytes_sent) allow to count round trips.
+
+Usage:
+    instrument = mso54.MSO54(sim_mso.ADDRESS, resource_manager=sim_mso.SimulatedResourceManager())
+    instrument.connect()
+"""
+
+from time import monotonic
+from time import sleep
+import numpy as np
+import pyvisa as visa
+
+ADDRESS = 'USB0::0x0699::0x0522::SIMULATED::INSTR'
+
+
+class SimulatedResourceManager:
+    """Stand-in for pyvisa.ResourceManager offering simulated instruments"""
+
+    # constructor
+    def __init__(self, instruments=None, **options):
+        # options are passed to the default SimulatedMSO if no instruments (address -> SimulatedMSO) are given
+        self.instruments = {ADDRESS: SimulatedMSO(ADDRESS, **options)} if instruments is None else instruments
+
+    def list_resources(self, query='?*::INSTR'):
+        return tuple(self.instruments)
+
+    def resource_info(self, address):
+        return self.__instrument(address)
+
+    def open_resource(self, address, open_timeout=None, **kwargs):
+        instrument = self.__instrument(address)
+        instrument.is_open = True
+        return instrument
+
+    def __instrument(self, address):
+        try:
+            return self.instruments[address]
+        except KeyError:
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_resource_not_found)
+
+
+class SimulatedMSO:
+    """In-process fake of a 5 series MSO on the level of pyvisa resource calls"""
+
+    IDN = 'TEKTRONIX,{0},SIMULATED,CF:91.1CT FV:1.0.0'
+    SAMPLE_RATE = 6.25e9  # samples/s
+    Y_MULT = 1.5625e-5  # V per code
+    REDUCED_POINTS = 10000  # maximum record length with DATa:RESOlution REDUced
+
+    # constructor
+    def __init__(self, resource_name=ADDRESS, latency=0.0005, bandwidth=40e6, record_length=100000,
+                 channels=('CH1', 'CH2', 'CH3', 'CH4'), acquisition_time=0.01, multi_source=True, digital=(),
+                 reduced_resolution=True, model='MSO54', adc_bits=12):
+        self.resource_name = resource_name
+        self.interface_type = visa.constants.InterfaceType.usb
+        self.timeout = 2000  # ms
+        self.latency = latency  # s per command
+        self.bandwidth = bandwidth  # bytes/s of the binary data
+        self.record_length = record_length
+        self.channels = list(channels)
+        self.digital = list(digital)  # logic sources, e.g. CH4_DALL (8 lanes) or CH4_D0 (single lane)
+        self.acquisition_time = acquisition_time  # s from arming to completion
+        self.multi_source = multi_source
+        self.reduced_resolution = reduced_resolution  # DATa:RESOlution is known
+        self.model = model
+        self.adc_bits = adc_bits  # resolution of the samples in SAMple and PEAKdetect mode (left-justified codes)
+        self.is_open = False
+        self.reset_counters()
+        self.reset()
+
+    def reset_counters(self):
+        self.writes = 0
+        self.queries = 0
+        self.bytes_sent = 0
+
+    # instrument state after *RST
+    def reset(self):
+        self.settings = {'DATA:SOURCE': self.channels[0], 'DATA:ENCDG': 'RIBINARY', 'WFMOUTPRE:BYT_NR': '1',
+                         'DATA:START': '1', 'DATA:STOP': str(self.record_length), 'DATA:FRAMESTART': '1',
+                         'DATA:FRAMESTOP': '1', 'ACQUIRE:STOPAFTER': 'RUNSTOP', 'HORIZONTAL:FASTFRAME:STATE': 'OFF',
+                         'HORIZONTAL:FASTFRAME:COUNT': '1', 'DESE': '255', '*ESE': '0', '*SRE': '0',
+                         'ACQUIRE:MODE': 'SAMPLE', 'DATA:RESOLUTION': 'FULL', 'TRIGGER:A:TYPE': 'EDGE',
+                         'TRIGGER:A:MODE': 'NORMAL', 'TRIGGER:A:EDGE:SOURCE': self.channels[0],
+                         'TRIGGER:A:EDGE:SLOPE': 'RISE', 'TRIGGER:A:LEVEL:' + self.channels[0]: '0.0E+0'}
+        self.esr = 0
+        self.opc_pending = False
+        self.acquisition_done = 0.0
+        self.output = bytearray()  # response bytes not yet read with read_bytes()
+        self.__records = {}
+
+    # pyvisa resource interface
+    def close(self):
+        self.is_open = False
+
+    def clear(self):
+        self.output = bytearray()
+
+    def write(self, command):
+        if command.strip().endswith('?'):  # e.g. CURVe? read back with read_bytes()/readinto()
+            self.queries += 1
+        else:
+            self.writes += 1
+        sleep(self.latency)
+        for message in command.strip().split(';'):
+            self.__execute(message.strip())
+
+    def query(self, command):
+        self.queries += 1
+        sleep(self.latency)
+        return self.__query(command.strip()) + '\n'
+
+    def query_binary_values(self, command, datatype='b', is_big_endian=False, container=list, data_points=None,
+                            **kwargs):
+        self.queries += 1
+        sleep(self.latency)
+        if command.strip().upper() != 'CURVE?':
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+        data = self.__curve(self.settings['DATA:SOURCE'].split(',')[0])
+        self.__send(data.nbytes)
+        return container(data)
+
+    def read_bytes(self, count, chunk_size=None, break_on_termchar=False):
+        if len(self.output) < count:
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+        data = bytes(self.output[:count])
+        del self.output[:count]
+        return data
+
+    # receives the response straight into a writable buffer (like io.RawIOBase.readinto), returns the byte count
+    def readinto(self, buffer):
+        count = min(len(buffer), len(self.output))
+        if count == 0:
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+        buffer[:count] = self.output[:count]
+        del self.output[:count]
+        return count
+
+    def enable_event(self, event_type, mechanism, context=None):
+        pass
+
+    def disable_event(self, event_type, mechanism):
+        pass
+
+    def discard_events(self, event_type, mechanism):
+        pass
+
+    def wait_on_event(self, event_type, timeout):
+        # the service request is raised when the acquisition completes (OPC -> ESB -> SRQ)
+        if not self.__wait_for_acquisition(timeout):
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+
+    # SCPI handling
+    @staticmethod
+    def __normalize(header):
+        return header.upper().lstrip(':')
+
+    def __execute(self, message):
+        header, _, value = message.partition(' ')
+        header = self.__normalize(header)
+        if header == '*CLS':
+            self.esr = 0
+        elif header == '*RST':
+            self.reset()
+        elif header == '*OPC':
+            self.opc_pending = True
+        elif header == 'ACQUIRE:STATE':
+            if value.upper() in ('ON', 'RUN', '1'):
+                self.acquisition_done = monotonic() + self.acquisition_time
+                self.__records = {}  # a new acquisition delivers new data
+        elif header == 'CURVE?':
+            self.__curve_to_output()
+        elif header == 'DATA:RESOLUTION' and not self.reduced_resolution:
+            self.esr |= 0x20  # command error
+        elif header in self.settings:
+            self.settings[header] = value.strip().upper()
+        else:
+            self.esr |= 0x20  # command error
+
+    def __query(self, command):
+        header = self.__normalize(command)
+        if header == '*IDN?':
+            return self.IDN.format(self.model)
+        if header == '*ESR?':
+            if self.opc_pending and monotonic() >= self.acquisition_done:
+                self.opc_pending = False
+                self.esr |= 0x01
+            esr, self.esr = self.esr, 0
+            return str(esr)
+        if header == '*OPC?':
+            if not self.__wait_for_acquisition(self.timeout):
+                raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+            return '1'
+        if header == 'HORIZONTAL:RECORDLENGTH?':
+            return str(self.record_length)
+        if header == 'DATA:SOURCE:AVAILABLE?':
+            return ','.join(self.channels + self.digital)
+        if header == 'DATA:SOURCE?':
+            sources = self.settings['DATA:SOURCE'].split(',')
+            return ','.join(sources if self.multi_source else sources[:1])
+        if header == 'WFMOUTPRE?':
+            return self.__preamble(self.settings['DATA:SOURCE'].split(',')[0])
+        if header.startswith('HORIZONTAL:FASTFRAME:TIMESTAMP:ALL:'):
+            return ','.join('"01 Jan 2024 00:00:{0:02d}.{1:012d}"'.format(i // 1000 % 60, i % 1000 * 1000000)
+                            for i in range(self.__n_frames()))
+        if header[:-1] in self.settings:
+            return self.settings[header[:-1]]
+        self.esr |= 0x20  # command error
+        raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+
+    def __wait_for_acquisition(self, timeout_ms):
+        remaining = self.acquisition_done - monotonic()
+        if timeout_ms is not None and remaining > timeout_ms / 1000:
+            sleep(timeout_ms / 1000)
+            return False
+        sleep(max(remaining, 0.0))
+        if self.opc_pending:
+            self.opc_pending = False
+            self.esr |= 0x01
+        return True
+
+    # waveform data
+    def __n_frames(self):
+        if self.settings['HORIZONTAL:FASTFRAME:STATE'] in ('ON', '1'):
+            return int(self.settings['HORIZONTAL:FASTFRAME:COUNT'])
+        return 1
+
+    def __record(self, source):
+        if source in self.digital:
+            # 8 bit counter incremented every 100 samples, lane n toggles every 100 * 2 ** n samples
+            counter = (np.arange(self.record_length * self.__n_frames()) // 100 & 0xFF).astype(np.uint8)
+            lane = source.rsplit('_D', 1)[-1]
+            return counter if lane == 'ALL' else (counter >> int(lane)) & 1
+        # square wave with some noise, a different frequency per channel
+        if source not in self.__records:
+            n = self.record_length * self.__n_frames()
+            index = np.arange(n)
+            period = 1000 * (self.channels.index(source) + 1) if source in self.channels else 1000
+            square = np.where(index % period < period // 2, 16000, -16000)
+            noise = np.random.default_rng(len(self.__records)).integers(-200, 200, n)
+            self.__records[source] = (square + noise).astype(np.int16)
+        return self.__records[source]
+
+    def __range(self):
+        start = max(int(self.settings['DATA:START']), 1)
+        stop = min(int(self.settings['DATA:STOP']), self.record_length)
+        return start, max(stop, start)
+
+    # every step-th sample is transferred with reduced resolution
+    def __step(self):
+        if self.settings['DATA:RESOLUTION'].startswith('RED'):
+            return -(-self.record_length // self.REDUCED_POINTS)
+        return 1
+
+    def __curve(self, source):
+        if source not in self.channels + self.digital:
+            self.esr |= 0x10  # execution error
+            return np.empty(0, dtype=np.int16)
+        start, stop = self.__range()
+        record = self.__record(source).reshape(-1, self.record_length)
+        first_frame = int(self.settings['DATA:FRAMESTART'])
+        last_frame = min(int(self.settings['DATA:FRAMESTOP']), len(record))
+        if len(record) == 1:
+            first_frame = last_frame = 1
+        data = record[first_frame - 1:last_frame, start - 1:stop:self.__step()].ravel()
+        if source in self.digital:
+            return data  # one unsigned byte per sample whatever the encoding
+        if not self.settings['ACQUIRE:MODE'].startswith(('HIR', 'AVE')):  # no bits added to the ADC samples
+            data = data & np.int16(-(1 << (16 - self.adc_bits)))
+        if self.settings['WFMOUTPRE:BYT_NR'] == '1':
+            return (data >> 8).astype(np.int8)
+        if self.settings['DATA:ENCDG'] in ('SFPBINARY', 'FPBINARY'):
+            return data.astype('<f4')  # same scaling as the integer codes
+        return data.astype('<i2')
+
+    def __curve_to_output(self):
+        blocks = []
+        for source in self.settings['DATA:SOURCE'].split(',')[:None if self.multi_source else 1]:
+            data = self.__curve(source).tobytes()
+            length = str(len(data)).encode('ascii')
+            blocks.append(b'#' + str(len(length)).encode('ascii') + length + data)
+            self.__send(len(data))
+        self.output += b';'.join(blocks) + b'\n'
+
+    def __send(self, n_bytes):
+        self.bytes_sent += n_bytes
+        if self.bandwidth:
+            sleep(n_bytes / self.bandwidth)
+
+    def __preamble(self, source):
+        start, stop = self.__range()
+        n_byte = int(self.settings['WFMOUTPRE:BYT_NR'])
+        y_mult = self.Y_MULT * (256 if n_byte == 1 else 1)
+        bn_fmt = 'FP' if self.settings['DATA:ENCDG'] in ('SFPBINARY', 'FPBINARY') else 'RI'
+        wfm_type = 'ANALOG'
+        if source in self.digital:
+            n_byte, y_mult, bn_fmt, wfm_type = 1, 1.0, 'RP', 'DIGITAL'
+        x_zero = (start - 1 - self.record_length // 2) / self.SAMPLE_RATE  # trigger in the middle of the record
+        x_incr = self.__step() / self.SAMPLE_RATE
+        fields = [n_byte, 8 * n_byte, 'BINARY', bn_fmt, 'LSB',
+                  '"{0}, DC coupling, 100.0mV/div, simulated"'.format(source.capitalize()),
+                  len(range(start, stop + 1, self.__step())),
+                  'Y', 'LINEAR', '"s"', '{0:.4E}'.format(x_incr), '{0:.4E}'.format(x_zero), 0, '"V"',
+                  '{0:.4E}'.format(y_mult), '0.0E+0', '0.0E+0', 'TIME', wfm_type, '0.0E+0', '0.0E+0', '0.0E+0']
+        return ';'.join(str(field) for field in fields)
@@ -0,0 +1,149 @@
+""" Per-command tracing of the VISA I/O of an instrument driver.
+
+TracedResource wraps a pyvisa resource and records every write, query and binary transfer in an IOStatistics object:
+counts, latency histograms, transferred bytes and errors per SCPI command, plus a bounded list of the latest calls
+which can be exported in the Chrome trace event format (chrome://tracing, Perfetto).
+"""
+
+import json
+import threading
+from collections import deque
+from time import perf_counter
+import numpy as np
+
+# upper bounds of the latency histogram buckets in s, the last bucket takes everything above
+LATENCY_BUCKETS = (1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1, 1.0, 3.0, 10.0)
+# methods sending an SCPI message (the others read responses or wait)
+MESSAGE_METHODS = ('write', 'query', 'query_binary_values')
+
+
+class IOStatistics:
+    """Thread-safe collection of I/O statistics per SCPI command"""
+
+    # constructor
+    def __init__(self, max_events=10000):
+        self.__lock = threading.Lock()
+        self.__epoch = perf_counter()
+        self.__commands = {}
+        self.__events = deque(maxlen=max_events)
+
+    def reset(self):
+        with self.__lock:
+            self.__commands = {}
+            self.__events.clear()
+
+    def record(self, command, method, start, duration, n_bytes, error=None):
+        with self.__lock:
+            entry = self.__commands.get(command)
+            if entry is None:
+                entry = {"count": 0, "messages": 0, "errors": 0, "bytes": 0, "time": 0.0, "min_time": duration,
+                         "max_time": duration, "histogram": [0] * (len(LATENCY_BUCKETS) + 1)}
+                self.__commands[command] = entry
+            entry["count"] += 1
+            entry["messages"] += method in MESSAGE_METHODS
+            entry["errors"] += error is not None
+            entry["bytes"] += n_bytes
+            entry["time"] += duration
+            entry["min_time"] = min(entry["min_time"], duration)
+            entry["max_time"] = max(entry["max_time"], duration)
+            entry["histogram"][int(np.searchsorted(LATENCY_BUCKETS, duration))] += 1
+            self.__events.append((command, method, start, duration, n_bytes, error, threading.get_ident()))
+
+    # returns a copy of the statistics per command
+    def stats(self):
+        with self.__lock:
+            return {command: dict(entry, histogram=list(entry["histogram"]))
+                    for command, entry in self.__commands.items()}
+
+    def totals(self):
+        with self.__lock:
+            entries = list(self.__commands.values())
+        return {"count": sum(entry["count"] for entry in entries),
+                "messages": sum(entry["messages"] for entry in entries),
+                "errors": sum(entry["errors"] for entry in entries),
+                "bytes": sum(entry["bytes"] for entry in entries),
+                "time": sum(entry["time"] for entry in entries)}
+
+    # file export (file names)
+    def export_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({"latency_buckets": list(LATENCY_BUCKETS), "commands": self.stats()}, f, indent=2)
+
+    def export_chrome_trace(self, filename):
+        with self.__lock:
+            events = list(self.__events)
+        trace = [{"name": command, "cat": method, "ph": "X", "pid": 1, "tid": thread,
+                  "ts": 1e6 * (start - self.__epoch), "dur": 1e6 * duration,
+                  "args": {"bytes": n_bytes, "error": None if error is None else str(error)}}
+                 for command, method, start, duration, n_bytes, error, thread in events]
+        with open(filename, 'w') as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+class TracedResource:
+    """Proxy of a pyvisa resource recording the I/O in an IOStatistics object
+
+    All attributes not related to I/O are passed through to the wrapped resource.
+    """
+
+    # constructor
+    def __init__(self, resource, statistics):
+        object.__setattr__(self, '_resource', resource)
+        object.__setattr__(self, '_statistics', statistics)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._resource, name)
+        if name == 'readinto':  # optional, only offered if the wrapped resource has it
+            return lambda buffer, *args, **kwargs: self.__call('readinto', 'readinto', attribute, buffer, *args,
+                                                               **kwargs)
+        return attribute
+
+    def __setattr__(self, name, value):
+        setattr(self._resource, name, value)  # e.g. timeout
+
+    @staticmethod
+    def _command(message):
+        return message.strip().split(' ')[0]
+
+    def __call(self, command, method, func, *args, **kwargs):
+        start = perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            self._statistics.record(command, method, start, perf_counter() - start, 0, error)
+            raise
+        self._statistics.record(command, method, start, perf_counter() - start, self.__size(method, args, result))
+        return result
+
+    @staticmethod
+    def __size(method, args, result):
+        if method == 'write':
+            return len(args[0])
+        if method == 'wait_on_event':
+            return 0
+        if isinstance(result, np.ndarray):
+            return result.nbytes
+        if isinstance(result, int):  # number of bytes read into a buffer
+            return result
+        return len(result)
+
+    def write(self, message, *args, **kwargs):
+        return self.__call(self._command(message), 'write', self._resource.write, message, *args, **kwargs)
+
+    def query(self, message, *args, **kwargs):
+        return self.__call(self._command(message), 'query', self._resource.query, message, *args, **kwargs)
+
+    def query_binary_values(self, message, *args, **kwargs):
+        return self.__call(self._command(message), 'query_binary_values', self._resource.query_binary_values,
+                           message, *args, **kwargs)
+
+    def read_bytes(self, count, *args, **kwargs):
+        return self.__call('read_bytes', 'read_bytes', self._resource.read_bytes, count, *args, **kwargs)
+
+    def wait_on_event(self, *args, **kwargs):
+        return self.__call('wait_on_event', 'wait_on_event', self._resource.wait_on_event, *args, **kwargs)
+
+
+# the wrapped resource of a TracedResource (e.g. for I/O which is recorded by the caller), otherwise the resource
+def untraced(resource):
+    return resource._resource if isinstance(resource, TracedResource) else resource
@@ -1,7 +1,10 @@
+import queue
+import sys
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import font
 from tkinter import messagebox
+from tkinter import simpledialog
 from tkinter import ttk
 
 
@@ -13,14 +16,33 @@ import warnings
 
 import numpy as np
 
+from decimate import EnvelopeDecimator
+from digital import DigitalWaveform
+
 
 class View:
+    POST_INTERVAL_MS = 20  # interval in which functions posted from other threads are called
+    RANGE_CHANGED_DELAY_MS = 250  # the visible range is reported after zooming or panning has paused this long
+    # rows of the measurement table: result key, label and unit (see measure)
+    MEASUREMENTS = (('frequency', 'frequency', 'Hz'), ('period', 'period', 's'), ('rise_time', 'rise time', 's'),
+                    ('fall_time', 'fall time', 's'), ('mean', 'mean', 'V'), ('rms', 'RMS', 'V'),
+                    ('ac_rms', 'AC RMS', 'V'), ('peak_to_peak', 'peak-peak', 'V'), ('max', 'maximum', 'V'),
+                    ('min', 'minimum', 'V'), ('top', 'top', 'V'), ('base', 'base', 'V'),
+                    ('amplitude', 'amplitude', 'V'), ('overshoot', 'overshoot', '%'), ('preshoot', 'preshoot', '%'),
+                    ('spectral_peak', 'spectral peak', 'Hz'))
+    LANE_SPACING = 1.5  # vertical distance of the digital lanes on the second axes
+    SI_PREFIXES = ((1e9, 'G'), (1e6, 'M'), (1e3, 'k'), (1.0, ''), (1e-3, 'm'), (1e-6, 'u'), (1e-9, 'n'),
+                   (1e-12, 'p'))
+
     # constructor
     def __init__(self, control):
         self.control = control
         self.window = tk.Tk()
         self.window.title(self.control.window_title)
         self.window.geometry('640x480')
+        self.window.protocol('WM_DELETE_WINDOW', self.control.window_close)
+        self.__posted = queue.Queue()
+        self.window.after(self.POST_INTERVAL_MS, self.__call_posted)
 
         # create all of the main containers
         toolbar_frame = tk.Frame(self.window, bg='white', width=640, height=50)
@@ -40,8 +62,26 @@ class View:
         t = np.arange(0, 3, .01)
         self.ax1 = self.fig.add_subplot(111)
         self.ax2 = self.ax1.twinx()  # instantiate a second axes that shares the same x-axis
+        self.ax1.grid(True, which='both', axis='both')
+        self.ax1.set_xlabel('time in s')
+        self.ax1.set_ylabel('voltage in V')
+        # the lines are reused for all plots, their data is re-decimated to the visible range on zoom and pan
+        self.__lines = []
+        self.__waveforms = []
+        self.__decimators = []
+        # full resolution regions of the waveforms (interactive mode), shown instead of them where they cover the view
+        self.__details = []
+        self.__detail_decimators = []
+        self.__range_timer = None
+        self.__digital_lines = []  # one step line per lane of the digital waveforms on ax2
+        self.ax2.set_yticks([])
+        self.ax1.callbacks.connect('xlim_changed', self.__xlim_changed)
+        # in live mode the line is animated and blitted onto the background saved after every full redraw
+        self.__live = False
+        self.__background = None
         # self.ax.plot(np.arange(0, 3, .01), 2 * np.sin(2 * np.pi * t))
         self.canvas = FigureCanvasTkAgg(self.fig, master=canvas_frame)  # A tk.DrawingArea.
+        self.canvas.mpl_connect('draw_event', self.__canvas_drawn)
         self.canvas.draw()
         # layout the widgets in the canvas frame
         self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
@@ -57,23 +97,32 @@ class View:
 
         # create the widgets for the radio button frame
         font_1 = font.Font(family='Helvetica', size=14, weight='bold')
-        ttk.Label(rbutton_frame, text='Choose channel:', font=font_1, background='white').pack(side=tk.LEFT, padx=15)
-        self.channel = tk.StringVar()
-        self.channel_box = ttk.Combobox(rbutton_frame, width=27, textvariable=self.channel, state='readonly')
+        ttk.Label(rbutton_frame, text='Choose channels:', font=font_1, background='white').pack(side=tk.LEFT, padx=15)
+        self.channel_box = tk.Listbox(rbutton_frame, width=27, height=4, selectmode=tk.MULTIPLE, exportselection=False)
         self.channel_box.pack(side=tk.LEFT, padx=15)
+        self.interactive = tk.BooleanVar(value=False)
+        tk.Checkbutton(rbutton_frame, text='zoom fetches details', variable=self.interactive,
+                       background='white').pack(side=tk.LEFT, padx=15)
 
         # create the widgets for the button frame
         helv36 = font.Font(family='Helvetica', size=18, weight='bold')
         tk.Button(button_frame, text="read", command=self.control.button_read_click,
                   padx=20, pady=10, font=helv36).pack(side=tk.LEFT, expand=True)
+        self.run_button = tk.Button(button_frame, text="run", command=self.control.button_run_click,
+                                    padx=20, pady=10, font=helv36)
+        self.run_button.pack(side=tk.LEFT, expand=True)
         tk.Button(button_frame, text="import", command=self.control.button_import_click,
                   padx=20, pady=10, font=helv36).pack(side=tk.LEFT, expand=True)
         tk.Button(button_frame, text="export", command=self.control.button_export_click,
                   padx=20, pady=10, font=helv36).pack(side=tk.LEFT, expand=True)
+        tk.Button(button_frame, text="measure", command=self.control.button_measure_click,
+                  padx=20, pady=10, font=helv36).pack(side=tk.LEFT, expand=True)
 
         # create the widgets for the statusbar frame
         self.statusbar = tk.Label(statusbar_frame, text="MSO54: undefined state", bd=1, relief=tk.SUNKEN, anchor=tk.W)
+        self.perfbar = tk.Label(statusbar_frame, text="", bd=1, relief=tk.SUNKEN, anchor=tk.E)
         # layout the widgets in the statusbar frame
+        self.perfbar.pack(side=tk.RIGHT)
         self.statusbar.pack(fill=tk.X)
 
     # destructor
@@ -85,11 +134,47 @@ class View:
     def show(self):
         self.window.mainloop()
 
+    def close(self):
+        self.window.destroy()
+
+    # tkinter must only be used by the thread running the mainloop, other threads hand their GUI updates over with
+    # post(func)
+    def post(self, func):
+        self.__posted.put(func)
+
+    def __call_posted(self):
+        try:
+            while True:
+                try:
+                    func = self.__posted.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    func()
+                except Exception as error:  # the following updates must not be lost
+                    print('Error in posted GUI update: {0!r}'.format(error), file=sys.stderr)
+        finally:
+            self.window.after(self.POST_INTERVAL_MS, self.__call_posted)
+
     def update_statusbar(self, status):
         self.statusbar['text'] = 'MSO54: ' + status
 
+    def update_perfbar(self, text):
+        self.perfbar['text'] = text
+
     def update_available_channels(self, available_channels):
-        self.channel_box['values'] = available_channels
+        available_channels = list(available_channels or [])
+        if list(self.channel_box.get(0, tk.END)) == available_channels:
+            return
+        selected = self.selected_channels()
+        self.channel_box.delete(0, tk.END)
+        for index, channel in enumerate(available_channels):
+            self.channel_box.insert(tk.END, channel)
+            if channel in selected:
+                self.channel_box.selection_set(index)
+
+    def selected_channels(self):
+        return [self.channel_box.get(index) for index in self.channel_box.curselection()]
 
     def timer(self, interval_ms, func):
         self.window.after(interval_ms, lambda: self.__timer_routine(interval_ms, func))
@@ -98,16 +183,142 @@ class View:
         func()
         self.window.after(interval_ms, lambda: self.__timer_routine(interval_ms, func))
 
-    def simple_plot(self, x, y):
-        self.ax1.plot(x, y, linestyle='-')
-        self.ax1.grid(b=True, which='both', axis='both')
-        # self.ax1.legend(loc='upper right')
-        self.ax1.margins(x=0)
-        self.ax1.set_xlabel('time in s')
-        self.ax1.set_ylabel('voltage in V')
+    # Plots the waveforms (e.g. several channels of one acquisition) with one reused line per waveform. Digital
+    # waveforms (see digital) are drawn lane by lane as step lines through their edges on the second axes.
+    def plot_waveforms(self, waveforms):
+        digital = [waveform for waveform in waveforms if isinstance(waveform, DigitalWaveform)]
+        self.__plot_digital(digital)
+        self.__waveforms = [waveform for waveform in waveforms if not isinstance(waveform, DigitalWaveform)]
+        self.__details, self.__detail_decimators = [], []
+        self.__decimators = [EnvelopeDecimator(waveform.raw) for waveform in self.__waveforms]
+        while len(self.__lines) < len(self.__waveforms):
+            line, = self.ax1.plot([], [], linestyle='-', animated=self.__live)
+            self.__lines.append(line)
+        for line in self.__lines[len(self.__waveforms):]:
+            line.set_data([], [])
+            line.set_label('_nolegend_')
+        y_min, y_max = np.inf, -np.inf
+        for line, waveform, decimator in zip(self.__lines, self.__waveforms, self.__decimators):
+            line.set_label(waveform.channel or '_nolegend_')
+            _, codes = decimator.decimate(0, len(waveform), self.__plot_width())
+            if len(codes):
+                volts = waveform.to_volts(codes)
+                y_min, y_max = min(y_min, volts.min()), max(y_max, volts.max())
+        if y_min <= y_max:
+            margin = 0.05 * (y_max - y_min) or 0.5
+            self.ax1.set_ylim(y_min - margin, y_max + margin)
+        if len(self.__waveforms) > 1:
+            self.ax1.legend(loc='upper right')
+        elif self.ax1.get_legend() is not None:
+            self.ax1.get_legend().remove()
+        if self.__waveforms or digital:
+            t_start = min(waveform.t_start for waveform in self.__waveforms + digital)
+            t_stop = max(waveform.t_stop for waveform in self.__waveforms + digital)
+            self.ax1.set_xlim(t_start, t_stop)  # re-decimates via __xlim_changed
         self.fig.tight_layout()
         self.canvas.draw()
 
+    # Shows full resolution regions of the plotted waveforms (one per waveform, see regions) wherever they cover the
+    # visible range, the overview is shown outside of them. An empty list shows the overview only.
+    def show_details(self, waveforms):
+        self.__details = list(waveforms)
+        self.__detail_decimators = [EnvelopeDecimator(waveform.raw) for waveform in self.__details]
+        self.__update_lines()
+        self.canvas.draw_idle()
+
+    # True if the read button should fetch an overview and details on zoom (interactive mode)
+    def interactive_mode(self):
+        return self.interactive.get()
+
+    def __plot_digital(self, waveforms):
+        lanes = [(waveform, lane) for waveform in waveforms for lane in range(waveform.n_lanes)]
+        while len(self.__digital_lines) < len(lanes):
+            line, = self.ax2.plot([], [], linestyle='-', drawstyle='steps-post', linewidth=1)
+            self.__digital_lines.append(line)
+        for line in self.__digital_lines[len(lanes):]:
+            line.set_data([], [])
+        names = []
+        for position, (line, (waveform, lane)) in enumerate(zip(self.__digital_lines, lanes)):
+            times, levels = waveform.step_trace(lane)  # edges only, independent of the record length
+            line.set_data(times, levels + self.LANE_SPACING * position)
+            names.append(waveform.lane_names[lane])
+        self.ax2.set_yticks([self.LANE_SPACING * position + 0.5 for position in range(len(names))])
+        self.ax2.set_yticklabels(names)
+        if names:
+            self.ax2.set_ylim(-0.5, self.LANE_SPACING * len(names))
+
+    def start_live(self):
+        self.__live = True
+        self.run_button['text'] = 'stop'
+        self.__plot_digital([])  # live mode shows a single analog channel
+        for line in self.__lines:
+            line.set_animated(True)
+        self.canvas.draw()  # saves the background without the lines
+
+    def stop_live(self):
+        self.__live = False
+        self.run_button['text'] = 'run'
+        for line in self.__lines:
+            line.set_animated(False)
+        self.__background = None
+        self.canvas.draw()
+
+    # Shows a new frame in live mode. As long as the time axis of the record does not change, only the line is
+    # redrawn (blitted) onto the saved background.
+    def update_live(self, waveform):
+        previous = self.__waveforms
+        if len(previous) != 1 or (previous[0].t_start, previous[0].t_stop) != (waveform.t_start, waveform.t_stop):
+            self.plot_waveforms([waveform])
+            return
+        self.__waveforms = [waveform]
+        self.__decimators = [EnvelopeDecimator(waveform.raw)]
+        self.__details, self.__detail_decimators = [], []
+        self.__update_lines()
+        if self.__background is None:
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self.__background)
+            self.ax1.draw_artist(self.__lines[0])
+            self.canvas.blit(self.fig.bbox)
+
+    def __canvas_drawn(self, event):
+        if self.__live:
+            self.__background = self.canvas.copy_from_bbox(self.fig.bbox)
+            for line in self.__lines:
+                self.ax1.draw_artist(line)  # animated artists are not part of a full redraw
+
+    # number of min/max bins, i.e. the width of the axes in pixels
+    def __plot_width(self):
+        return max(int(self.ax1.bbox.width), 100)
+
+    # re-decimates the visible range of every waveform (or of its detail if that covers the range)
+    def __update_lines(self):
+        t_start, t_stop = self.ax1.get_xlim()
+        for i, (line, waveform, decimator) in enumerate(zip(self.__lines, self.__waveforms, self.__decimators)):
+            if i < len(self.__details):
+                detail = self.__details[i]
+                tolerance = detail.x_incr / 2
+                if (detail.t_start - tolerance <= max(t_start, waveform.t_start)
+                        and detail.t_stop + tolerance >= min(t_stop, waveform.t_stop)):
+                    waveform, decimator = detail, self.__detail_decimators[i]
+            # one sample more on each side, so the line reaches the borders of the axes
+            start, stop = waveform.index_at((t_start, t_stop)) + (-1, 2)
+            index, codes = decimator.decimate(start, stop, self.__plot_width())
+            line.set_data(waveform.time_at(index), waveform.to_volts(codes))
+
+    def __xlim_changed(self, ax):
+        if not self.__waveforms:
+            return
+        self.__update_lines()
+        self.canvas.draw_idle()
+        if self.__range_timer is not None:
+            self.window.after_cancel(self.__range_timer)
+        self.__range_timer = self.window.after(self.RANGE_CHANGED_DELAY_MS, self.__range_changed)
+
+    def __range_changed(self):
+        self.__range_timer = None
+        self.control.view_range_changed(*self.ax1.get_xlim())
+
     # def loglog_plot(self, x, y1, y2):
     #     self.ax1.set_xlabel('freq / Hz')
     #     self.ax1.set_ylabel('Trace A')
@@ -137,16 +348,57 @@ class View:
     #         self.ax1.legend()
     #     self.canvas.draw()
 
+    # shows the results of measure.measure() in a table with one column per waveform
+    def show_measurements(self, waveforms, results):
+        window = tk.Toplevel(self.window)
+        window.title('Measurements')
+        columns = [waveform.channel or 'waveform {0}'.format(i + 1) for i, waveform in enumerate(waveforms)]
+        table = ttk.Treeview(window, columns=columns, height=len(self.MEASUREMENTS))
+        table.heading('#0', text='')
+        for column in columns:
+            table.heading(column, text=column)
+            table.column(column, anchor=tk.E, width=110)
+        for key, label, unit in self.MEASUREMENTS:
+            table.insert('', tk.END, text=label, values=[self.format_value(result[key], unit) for result in results])
+        table.pack(fill=tk.BOTH, expand=True)
+
+    @classmethod
+    def format_value(cls, value, unit):
+        if value is None or not np.isfinite(value):
+            return '-'
+        if unit == '%':
+            return '{0:.2f} %'.format(value)
+        for factor, prefix in cls.SI_PREFIXES:
+            if abs(value) >= factor or value == 0 and factor == 1.0:
+                break
+        return '{0:.4g} {1}{2}'.format(value / factor, prefix, unit)
+
     def show_errorbox(self, title, message):
         messagebox.showerror(title, message)
 
     def show_warningbox(self, title, message):
         messagebox.showwarning(title, message)
 
-    def save_as_csvfile_dialog(self):
-        return filedialog.asksaveasfile(mode='wb', defaultextension=".npz",
-                                        filetypes=(("compressed numpy arrays", "*.npz"), ("all files", "*.*")))
+    def ask_yes_no_cancel(self, title, message):
+        return messagebox.askyesnocancel(title, message)
+
+    def ask_ok_cancel(self, title, message):
+        return messagebox.askokcancel(title, message)
+
+    def ask_string(self, title, prompt, initial_value=None):
+        return simpledialog.askstring(title, prompt, initialvalue=initial_value, parent=self.window)
+
+    # returns the file name only, as existing files might have to be appended to (see Control.button_export_click)
+    def export_file_dialog(self):
+        return filedialog.asksaveasfilename(defaultextension=".msocap", confirmoverwrite=False,
+                                            filetypes=(("MSO capture files", "*.msocap"),
+                                                       ("MSO archives (appended)", "*.msoarc"),
+                                                       ("compressed numpy arrays", "*.npz"),
+                                                       ("comma separated values", "*.csv"),
+                                                       ("SPICE subcircuit libraries", "*.lib"),
+                                                       ("all files", "*.*")))
 
     def read_as_csvfile_dialog(self):
-        return filedialog.askopenfile(mode='rb', defaultextension=".npz",
-                                      filetypes=(("compressed numpy arrays", "*.npz"), ("all files", "*.*")))
+        return filedialog.askopenfile(mode='rb', defaultextension=".msocap",
+                                      filetypes=(("MSO capture files", "*.msocap"), ("MSO archives", "*.msoarc"),
+                                                 ("compressed numpy arrays", "*.npz"), ("all files", "*.*")))
@@ -0,0 +1,96 @@
+""" Compact waveform container for data fetched from Tektronix MSO oscilloscopes.
+
+The raw codes are kept as delivered by the instrument (int16 for SRIbinary with two bytes) together with the
+preamble scale factors. Volts and time are only computed on demand, either for the whole record or for a slice.
+"""
+
+import numpy as np
+
+
+class Waveform:
+    __slots__ = ('raw', 'y_mult', 'y_zero', 'x_incr', 'x_zero', 'pt_off', 'channel', 'timestamp')
+
+    # constructor
+    def __init__(self, raw, y_mult=1.0, y_zero=0.0, x_incr=1.0, x_zero=0.0, pt_off=0, channel=None, timestamp=None):
+        self.raw = raw
+        self.y_mult = float(y_mult)
+        self.y_zero = float(y_zero)
+        self.x_incr = float(x_incr)
+        self.x_zero = float(x_zero)
+        self.pt_off = int(pt_off)
+        self.channel = channel
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_preamble(cls, raw, preamble, channel=None, timestamp=None):
+        return cls(raw, preamble["y_mult"], preamble["y_zero"], preamble["x_incr"], preamble["x_zero"],
+                   preamble["pt_off"], channel=channel, timestamp=timestamp)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, item):
+        # slicing returns a waveform sharing the raw codes with the time axis shifted accordingly
+        if not isinstance(item, slice):
+            raise TypeError('Waveform indices must be slices')
+        start, stop, step = item.indices(len(self.raw))
+        if step != 1:
+            raise ValueError('Waveform slices must not have a step')
+        return Waveform(self.raw[start:stop], self.y_mult, self.y_zero, self.x_incr,
+                        self.x_zero + start * self.x_incr, self.pt_off, self.channel, self.timestamp)
+
+    @property
+    def sample_period(self):
+        return self.x_incr
+
+    @property
+    def t_start(self):
+        return (-1 * self.pt_off * self.x_incr) + self.x_zero
+
+    @property
+    def t_stop(self):
+        return self.t_start + (len(self.raw) - 1) * self.x_incr
+
+    def to_volts(self, codes, out=None):
+        # scaled_data = ((raw_data - y_off) * y_mult) + y_zero
+        if out is None:
+            return (codes * self.y_mult) + self.y_zero  # MSO54: y_off is always zero!
+        # in place into a preallocated float array (e.g. from a buffer_pool.BufferPool) without temporaries
+        out = out[:len(codes)]
+        np.multiply(codes, self.y_mult, out=out, casting='same_kind')
+        out += self.y_zero
+        return out
+
+    def volts(self, start=None, stop=None, out=None):
+        return self.to_volts(self.raw[start:stop], out)
+
+    def time(self, start=None, stop=None):
+        start, stop, _ = slice(start, stop).indices(len(self.raw))
+        return self.time_at(np.arange(start, stop))
+
+    def time_at(self, index):
+        return self.t_start + index * self.x_incr
+
+    def index_at(self, t):
+        # nearest sample index for a given time (clipped to the record)
+        index = np.rint((np.asarray(t) - self.t_start) / self.x_incr).astype(np.int64)
+        return np.clip(index, 0, len(self.raw) - 1)
+
+    # file methods
+    def save_npz(self, f):
+        np.savez(f, raw=self.raw, y_mult=self.y_mult, y_zero=self.y_zero, x_incr=self.x_incr, x_zero=self.x_zero,
+                 pt_off=self.pt_off, sample_period=self.x_incr,
+                 channel='' if self.channel is None else self.channel,
+                 timestamp=np.nan if self.timestamp is None else self.timestamp)
+
+    @classmethod
+    def load_npz(cls, f):
+        npz = np.load(f)
+        # the dictionary fields in npz have to be actively called in order to decompress and store the array in
+        # memory before being able to close the file
+        if 'raw' not in npz.files:
+            # files written by earlier versions only hold the data in volts and the sample period
+            return cls(npz["data"], x_incr=npz["sample_period"])
+        timestamp = float(npz["timestamp"])
+        return cls(npz["raw"], npz["y_mult"], npz["y_zero"], npz["x_incr"], npz["x_zero"], npz["pt_off"],
+                   channel=str(npz["channel"]) or None, timestamp=None if np.isnan(timestamp) else timestamp)